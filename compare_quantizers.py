@@ -0,0 +1,52 @@
+from src.pbn_gen import PbnGen
+import numpy as np
+import tracemalloc
+import time
+import sys
+import os
+
+
+def compare_quantizers(image_dir, num_colors=15):
+    """
+    Runs every PbnGen quantizer on the images in image_dir and prints the time, peak memory and color error of each.
+    The color error is the average CIELAB distance (delta E) between each original pixel and its quantized color.
+    """
+    image_names = sorted(
+        f for f in os.listdir(image_dir) if f.endswith((".jpg", ".jpeg", ".png"))
+    )
+
+    print(
+        f"{'image':<16}{'quantizer':<12}{'time (s)':>10}{'peak (MB)':>12}{'delta E':>10}"
+    )
+    for image_name in image_names:
+        for quantizer in PbnGen.QUANTIZERS:
+            # The fixed quantizer needs a palette rather than a number of colors
+            if quantizer == "fixed":
+                continue
+
+            pbn = PbnGen(
+                os.path.join(image_dir, image_name),
+                num_colors=num_colors,
+                quantizer=quantizer,
+            )
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            palette, labels, q_img = pbn.cluster_colors()
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            original = pbn.rgbToLab(pbn.img1d)
+            quantized = pbn.rgbToLab(palette * 255)[labels]
+            delta_e = np.mean(np.linalg.norm(original - quantized, axis=1))
+
+            print(
+                f"{image_name:<16}{quantizer:<12}{elapsed:>10.3f}{peak / 2**20:>12.1f}{delta_e:>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    compare_quantizers(
+        sys.argv[1] if len(sys.argv) > 1 else os.path.join("frontend", "public")
+    )
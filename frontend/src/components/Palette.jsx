@@ -37,7 +37,7 @@ const Palette = ({ idList, currentColor, setCurrentColor, colorCount }) => {
               onClick={() => setCurrentColor(value.color)}
             >
               <div style={overlayStyles((colorCount[value.color] / value.shapes.length) * 100)} />
-              {idx}
+              {value.number ?? idx}
             </div>
           }
       })}
@@ -4,9 +4,7 @@
 
 from firebase_functions import https_fn, options
 from firebase_admin import initialize_app, storage, credentials
-import numpy as np
-import cv2
-from pbn_gen import PbnGen
+from pbn_gen import PbnGen, decode_image
 import json
 
 cred = credentials.Certificate("credentials.json")
@@ -37,10 +35,18 @@ def make_pbn(req: https_fn.CallableRequest):
 
     try:
         base_id, _ = object_id.split(".")
-        nparr = np.frombuffer(contents, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        # JPEGs are decoded straight to the working resolution set_final_pbn() lowers them to
+        max_resolution = 200000
+        img, size = decode_image(contents, maxPixels=max_resolution)
 
-        pbn = PbnGen(img, num_colors=15)
+        pbn = PbnGen(
+            img,
+            num_colors=15,
+            quantizer="sampled",
+            max_resolution=max_resolution,
+            sourceSize=size,
+            keepOriginal=False,
+        )
         pbn.set_final_pbn()
         svg_output, palette = pbn.output_to_svg()
         palette_str = json.dumps(palette)
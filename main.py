@@ -1,17 +1,27 @@
-from src.pbn_gen import PbnGen
+from src.pbn_gen import PbnGen, batch_pbn
 import sys
 import os
 
 
 def main():
-    if not len(sys.argv) == 2:
+    if len(sys.argv) < 2:
         print("Error: No input image provided")
         exit(1)
 
-    input_image = sys.argv[1]
-    dir_name = os.path.dirname(input_image)
+    input_images = sys.argv[1:]
+    dir_name = os.path.dirname(input_images[0])
     try:
-        pbn = PbnGen(input_image)
+        if len(input_images) > 1:
+            # A series of images gets one shared palette and consistent numbering
+            batch_pbn(
+                input_images,
+                dir_name,
+                output_palette_path=os.path.join(dir_name, "pbn.json"),
+                reducedDecode=True,
+            )
+            return
+
+        pbn = PbnGen(input_images[0], keepOriginal=False, reducedDecode=True)
         pbn.set_final_pbn()
         pbn.output_to_svg(
             os.path.join(dir_name, "pbn.svg"), os.path.join(dir_name, "pbn.json")
@@ -14,13 +14,27 @@ except ImportError:
     print("Matplotlib not installed. Some features may not work properly.")
     MATPLOTLIB_AVAILABLE = False
 
+# Decode JPEGs at a reduced size with the full version's loader when it's available, this class is also the fallback
+# for when it can't be imported
+try:
+    from src.pbn_gen import decode_image
+except ImportError:
+    decode_image = None
+
 class SimplePbnGen:
     """
     A simplified version of PbnGen for the Streamlit demo
     """
+    # The longest side set_final_pbn() works at
+    MAX_DIM = 800
+
     def __init__(self, image_path, num_colors=15):
         # Read the image
-        if isinstance(image_path, str):
+        if isinstance(image_path, str) and decode_image is not None:
+            # It's a file path, JPEGs are decoded no larger than needed to fit in MAX_DIM
+            with open(image_path, 'rb') as f:
+                self.bgr_image, _ = decode_image(f.read(), outputSize=(self.MAX_DIM, self.MAX_DIM))
+        elif isinstance(image_path, str):
             # It's a file path
             self.bgr_image = cv2.imread(image_path)
         else:
@@ -37,7 +51,7 @@ class SimplePbnGen:
         """
         # Resize the image to a reasonable size
         h, w = self.image.shape[:2]
-        max_dim = 800
+        max_dim = self.MAX_DIM
         if max(h, w) > max_dim:
             scale = max_dim / max(h, w)
             new_size = (int(w * scale), int(h * scale))
@@ -3,50 +3,234 @@ from collections import Counter
 import numpy as np
 import matplotlib.pyplot as plt
 from sklearn.cluster import KMeans
+from sklearn.neighbors import KDTree
 from kneed import KneeLocator
 from sklearn.utils import shuffle
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 from shapely.geometry import Polygon, Point
 import svgwrite
 import json
 import random
+import heapq
+import os
+import tracemalloc
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import copy
 
 # Change me to an integer for consistent results between runs, or set to None to allow randomness in K-means
 random_state = None
 
+# Named paint kits that can be passed as the palette argument of PbnGen. Colors are RGB
+paint_kits = {
+    "basic12": [
+        (255, 255, 255),  # Titanium White
+        (20, 20, 20),  # Mars Black
+        (227, 0, 34),  # Cadmium Red
+        (160, 20, 40),  # Alizarin Crimson
+        (255, 236, 0),  # Cadmium Yellow
+        (203, 157, 6),  # Yellow Ochre
+        (138, 54, 15),  # Burnt Sienna
+        (101, 67, 33),  # Burnt Umber
+        (80, 125, 42),  # Sap Green
+        (18, 53, 36),  # Phthalo Green
+        (18, 10, 143),  # Ultramarine Blue
+        (42, 82, 190),  # Cerulean Blue
+    ],
+}
+
+# Lookup tables for fixed palettes keyed by (palette bytes, bits) so batch runs against the same paint kit only build one
+palette_lookup_cache = {}
+
 
 class PbnGen:
+    # Maps the quantizer constructor argument to the method cluster_colors() dispatches to. Every method takes no arguments,
+    # sets self.palette and self.labels, and returns (palette, labels). Subclasses can add their own entries.
+    #   kmeans: K means over every pixel. The slowest but highest quality option
+    #   sampled: K means fit in float32 on a stratified sample of at most sampleSize pixels, then every pixel is assigned
+    #   histogram: Weighted K means over the occupied bins of a color histogram with histogramBits bits per channel
+    #   mediancut: Deterministic weighted median cut over the color histogram, no iterations
+    #   octree: Deterministic octree reduction over the color histogram, no iterations
+    #   pyramid: K means fit on a downsampled pyramid level, then refined with a few Lloyd steps at the working resolution
+    #   fixed: Maps pixels onto the palette given to the constructor, no clustering. Picked automatically when a palette is given
+    QUANTIZERS = {
+        "kmeans": "cluster_colors_kmeans",
+        "sampled": "cluster_colors_sampled",
+        "histogram": "cluster_colors_histogram",
+        "mediancut": "cluster_colors_mediancut",
+        "octree": "cluster_colors_octree",
+        "pyramid": "cluster_colors_pyramid",
+        "fixed": "cluster_colors_fixed",
+    }
+
     def __init__(
-        self, f_name, num_colors=None, min_num_colors=10, pruningThreshold=6.25e-5
+        self,
+        f_name,
+        num_colors=None,
+        min_num_colors=10,
+        pruningThreshold=6.25e-5,
+        quantizer="kmeans",
+        sampleSize=100000,
+        histogramBits=5,
+        lookupBits=6,
+        autoColors="knee",
+        maxDeltaE=8,
+        palette=None,
+        colorSpace="rgb",
+        maxRefineIterations=10,
+        pruner="graph",
+        modeFilterSize=None,
+        modeFilterPasses=1,
+        blurType="bilateral",
+        maxPixels=None,
+        outputSize=None,
+        workingScale=0.5,
+        reducedDecode=False,
+        keepOriginal=True,
+        trackMemory=False,
+        tileSize=None,
+        tileOverlap=64,
+        tileWorkers=1,
     ):
-        bgr_image = cv2.imread(f_name)
-        # change to RGB
-        rgbImage = cv2.cvtColor(bgr_image, cv2.COLOR_BGR2RGB)
+        # With reducedDecode, JPEGs are decoded at the reduced size set_final_pbn() would work at anyway, see decode_image().
+        # Only turn it on when set_final_pbn() is what consumes the image, otherwise the image is decoded at full resolution
+        with open(f_name, "rb") as f:
+            bgr_image, self.sourceSize = decode_image(
+                f.read(),
+                *((maxPixels, outputSize, workingScale) if reducedDecode else ()),
+            )
+        # change to RGB, in place since nothing else holds the decoded image
+        rgbImage = cv2.cvtColor(bgr_image, cv2.COLOR_BGR2RGB, dst=bgr_image)
 
-        # Retain an original image copy for easy testing
-        self.originalImage = rgbImage
-        self.originalImg1d = self.get1DImg(self.originalImage)
+        # Retain the original image for easy testing. This is the decoded image, which can be smaller than sourceSize. It is
+        # read-only so the working image can share it until the first stage replaces it, and with keepOriginal=False it is
+        # freed as soon as that happens
+        rgbImage.flags.writeable = False
+        self.originalImage = rgbImage if keepOriginal else None
+        self.originalImg1d = self.get1DImg(rgbImage) if keepOriginal else None
+        self.setImage(rgbImage)
 
-        # Set the actual working image to a copy of the original
-        self.setImage(self.originalImage.copy())
+        # With trackMemory, set_final_pbn() traces the memory every stage allocates into self.memoryReport and prints it
+        self.trackMemory = trackMemory
+        self.memoryReport = []
+
+        # The pruners print their progress while verbose is set. processTiles() turns it off for the tiles
+        self.verbose = True
 
         # The minimum percentage of the image's area a color cluster can be before getting absorbed by surrounding colors
         self.pruningThreshold = pruningThreshold
 
-        # This will contain a dict of colors and binary masks of the pruned clusters
+        # This will contain a list of the clusters to prune with their color, area, bounding box and pixels
         self.prunableClusters = None
-
-        self.num_colors = num_colors if num_colors else self.get_num_clusters()
-        # make sure number of colors is at least minimum number
-        self.num_colors = (
-            self.num_colors + min_num_colors
-            if self.num_colors < min_num_colors
-            else self.num_colors
-        )
-        print(f"Quantized to {self.num_colors} colors")
+        # The number of clusters pruned in each iteration of pruneClustersSimple()
+        self.pruningHistory = []
+
+        # How set_final_pbn() removes small clusters. 'graph' merges them in one pass over a region adjacency graph with
+        # pruneClustersGraph(), 'simple' runs pruneClustersSimple(), 'fill' fills them from the nearest large clusters
+        # with pruneClustersFill() and None skips pruning
+        assert pruner in (
+            None,
+            "graph",
+            "simple",
+            "fill",
+        ), f"Unknown pruner {pruner}, expected None, 'graph', 'simple' or 'fill'"
+        self.pruner = pruner
+
+        # If set, set_final_pbn() smooths the quantized image with modeFilter() before pruning. With pruner=None this is a cheaper
+        # replacement for pruning which removes specks and jagged edges, but doesn't guarantee a minimum cluster size
+        self.modeFilterSize = modeFilterSize
+        self.modeFilterPasses = modeFilterPasses
+
+        # The blur set_final_pbn() starts with, see blurImage_() for the speed and quality of each option
+        self.blurType = blurType
+
+        # How set_final_pbn() picks its working resolution with planResolution(). It works at workingScale of the image at
+        # most, lower if needed to fit in maxPixels or in the (H, W) outputSize of the SVG. outputScale maps the working
+        # resolution to the SVG coordinates and svgSize is the (H, W) of the SVG, see planResolution()
+        self.maxPixels = maxPixels
+        self.outputSize = outputSize
+        self.workingScale = workingScale
+        self.outputScale = 1
+        self.svgSize = None
+
+        # With a tileSize, set_final_pbn() and output_to_svg() work on tileSize x tileSize tiles with tileOverlap pixels of
+        # margin instead of the whole image, using tileWorkers processes, see processTiles()
+        self.tileSize = tileSize
+        self.tileOverlap = tileOverlap
+        self.tileWorkers = tileWorkers
+
+        # Set by pruneClustersGraph() so later stages can use the merged regions and their neighbours
+        self.regionMap = None
+        self.regionColors = None
+        self.regionAreas = None
+        self.regionNeighbours = None
+
+        # Which color quantization method cluster_colors() uses, see PbnGen.QUANTIZERS for the options
+        assert (
+            quantizer in self.QUANTIZERS
+        ), f"Unknown quantizer {quantizer}, expected one of {list(self.QUANTIZERS)}"
+        self.quantizer = quantizer
+        self.sampleSize = sampleSize
+        self.histogramBits = histogramBits
+        # The palette and per pixel labels of the last quantizer run
+        self.palette = None
+        self.labels = None
+
+        # The color space the kmeans, sampled, histogram and mediancut quantizers cluster in. 'lab' clusters in CIELAB, which
+        # doesn't over-split dark tones like RGB does, so fewer colors are needed for the same visual quality. The palette is
+        # always converted back to RGB
+        assert colorSpace in (
+            "rgb",
+            "lab",
+        ), f"Unknown colorSpace {colorSpace}, expected 'rgb' or 'lab'"
+        self.colorSpace = colorSpace
+
+        # The pyramid quantizer refines its coarse palette with at most this many Lloyd steps at the working resolution
+        # and records how many were actually needed
+        self.maxRefineIterations = maxRefineIterations
+        self.refineIterations = None
+
+        # Bits per channel of the RGB -> palette index lookup tables used to assign pixels once a palette is known.
+        # 6 bits gives a 64^3 table and 8 bits an exact 256^3 one. The tables are built once per palette and cached here by the
+        # color space their distances are measured in, see getPaletteLookup()
+        self.lookupBits = lookupBits
+        self.paletteLookups = {}
+
+        # How the number of colors is picked when num_colors isn't given. 'knee' runs the K means knee search, 'histogram' median
+        # cuts the color histogram until the average CIELAB color error (delta E) is at most maxDeltaE, which takes milliseconds
+        assert autoColors in (
+            "knee",
+            "histogram",
+        ), f"Unknown autoColors {autoColors}, expected 'knee' or 'histogram'"
+        self.maxDeltaE = maxDeltaE
+
+        # A predefined palette skips clustering entirely, see loadPalette() for the accepted formats
+        self.fixedPalette = None
+        if palette is not None:
+            self.fixedPalette = self.loadPalette(palette)
+            self.quantizer = "fixed"
+            self.num_colors = self.fixedPalette.shape[0]
+            print(f"Using a fixed palette of {self.num_colors} colors")
+        else:
+            assert quantizer != "fixed", "The fixed quantizer needs a palette"
+            if num_colors:
+                self.num_colors = num_colors
+            elif autoColors == "histogram":
+                self.num_colors = self.get_num_clusters_histogram()
+            else:
+                self.num_colors = self.get_num_clusters()
+            # make sure number of colors is at least minimum number
+            self.num_colors = (
+                self.num_colors + min_num_colors
+                if self.num_colors < min_num_colors
+                else self.num_colors
+            )
+            print(f"Quantized to {self.num_colors} colors")
 
     def cluster_colors(self) -> "tuple[np.ndarray, np.ndarray, np.ndarray]":
         """
-        Performs K means clustering on the image to quantize it to a fixed number of colors.
+        Quantizes the image to a fixed number of colors with the quantizer chosen in the constructor.
 
         Returns:
             (palette, labels, q_img)
@@ -56,358 +240,1769 @@ class PbnGen:
             q_img: A (H, W, 3) quantized image which holds the original image quantized to the specified number of colors.
         """
 
+        palette, labels = getattr(self, self.QUANTIZERS[self.quantizer])()
+        q_img = palette[labels].reshape(self.image.shape)
+        return palette, labels, q_img
+
+    def cluster_colors_kmeans(self) -> "tuple[np.ndarray, np.ndarray]":
+        """
+        Performs K means clustering on the image to quantize it to a fixed number of colors.
+
+        Returns:
+            (palette, labels)
+
+            palette: A (N, 3) numpy array representing the quantized colors in a float32 format.
+            labels: A (H*W,) numpy array which holds the assigned labels for each pixel in the image.
+        """
+
         model = KMeans(
             n_clusters=self.num_colors, n_init="auto", random_state=random_state
         )
-        model.fit(self.img1d)
+        model.fit(self.toClusteringSpace(self.img1d))
 
         # get primary colors as floats from 0 to 1
-        self.palette = model.cluster_centers_ / 255
+        self.palette = self.fromClusteringSpace(model.cluster_centers_) / 255
+        # Lookup tables built for a previous palette no longer apply
+        self.paletteLookups = {}
         self.labels = model.labels_
         # get quantized image
-        q_img = self.palette[self.labels].reshape(self.image.shape)
-        return self.palette, self.labels, q_img
+        return self.palette, self.labels
 
-    def cluster_colors_(self):
+    def cluster_colors_sampled(self) -> "tuple[np.ndarray, np.ndarray]":
         """
-        An in-place clustering of colors, replaces existing image with the quantized version
+        A lower memory version of cluster_colors() for large images. K means is fit in float32 on a stratified sample of at most
+        self.sampleSize pixels, then every pixel of the full image is assigned to its nearest centroid through a palette lookup table.
+
+        Returns:
+            (palette, labels)
+
+            palette: A (N, 3) numpy array representing the quantized colors in a float32 format.
+            labels: A (H*W,) numpy array which holds the assigned labels for each pixel in the image.
         """
 
-        colors, labels, q_img = self.cluster_colors()
-        q_img = (q_img * 255).astype(np.uint8)
-        # print(q_img.dtype)
+        sample = self.getStratifiedSample(self.image, self.sampleSize)
+
+        model = KMeans(
+            n_clusters=self.num_colors, n_init="auto", random_state=random_state
+        )
+        model.fit(self.toClusteringSpace(sample))
 
-        self.setImage(q_img.copy())
+        centers = self.fromClusteringSpace(model.cluster_centers_).astype(np.float32)
+        self.palette = centers / 255
+        self.paletteLookups = {}
+        self.labels = self.lookupLabels(self.image, self.getPaletteLookup()).reshape(-1)
+        return self.palette, self.labels
 
-    def get_num_clusters(self):
+    def cluster_colors_histogram(
+        self,
+    ) -> "tuple[np.ndarray, np.ndarray]":
         """
-        Algorithmically gets optimal number of clusters for k means using knee method
+        Quantizes the image by running weighted K means over the occupied bins of a packed RGB histogram instead of over raw pixels.
+        The number of occupied bins is bounded by the bin count (32768 for 5 bits per channel), so the clustering cost does not depend
+        on the image size. Each pixel then gets the label of its bin through a lookup table.
 
         Returns:
-            numClusters: The optimal number of clusters found by the K Knee method
+            (palette, labels)
+
+            palette: A (N, 3) numpy array representing the quantized colors in a float32 format.
+            labels: A (H*W,) numpy array which holds the assigned labels for each pixel in the image.
         """
 
-        max_test = 25
-        num_samples = 10000
-        inertias = []
-        x_vals = np.arange(1, max_test)
-        for i in x_vals:
-            # run on sample to save time for approximation
-            image_arr_sample = shuffle(
-                self.img1d, random_state=0, n_samples=num_samples
-            )
-            kmeans = KMeans(n_clusters=i, n_init="auto", random_state=random_state)
-            kmeans.fit(image_arr_sample)
-            inertia = kmeans.inertia_
-            inertias.append(inertia)
+        binIndices, bins, counts, binColors = self.getColorHistogram(
+            self.img1d, self.histogramBits
+        )
 
-        # plt.plot(x_vals, inertias)
-        # plt.show()
+        # There can't be more clusters than occupied bins
+        numClusters = min(self.num_colors, bins.shape[0])
+        model = KMeans(n_clusters=numClusters, n_init="auto", random_state=random_state)
+        model.fit(self.toClusteringSpace(binColors), sample_weight=counts)
 
-        kn = KneeLocator(
-            x=x_vals,
-            y=inertias,
-            curve="convex",
-            direction="decreasing",
+        return self._quantizeBins(
+            binIndices,
+            bins,
+            model.labels_,
+            self.fromClusteringSpace(model.cluster_centers_),
         )
-        return kn.knee
 
-    def plt_cluster_pie(self):
+    def cluster_colors_mediancut(
+        self,
+    ) -> "tuple[np.ndarray, np.ndarray]":
         """
-        Plots a pie chart based on the percentage of each color in the image
+        Quantizes the image with a weighted median cut over the occupied bins of the color histogram. The palette is the
+        mean color of each box. Deterministic and non-iterative, so it is much faster than K means at a small cost in quality.
+
+        Returns:
+            (palette, labels)
+
+            palette: A (N, 3) numpy array representing the quantized colors in a float32 format.
+            labels: A (H*W,) numpy array which holds the assigned labels for each pixel in the image.
         """
 
-        unique_values, counts = np.unique(self.labels, return_counts=True)
-        percentages = (counts / len(self.labels)) * 100
-        plt.pie(
-            percentages,
-            colors=np.array(self.palette),
-            labels=np.arange(len(self.palette)),
+        binIndices, bins, counts, binColors = self.getColorHistogram(
+            self.img1d, self.histogramBits
+        )
+        boxes, _ = self.medianCut(
+            self.toClusteringSpace(binColors), counts, self.num_colors
         )
-        plt.show()
 
-    def resetImage(self):
+        binLabels = np.empty(bins.shape[0], dtype=np.int32)
+        for label, box in enumerate(boxes):
+            binLabels[box] = label
+
+        return self._quantizeBins(
+            binIndices,
+            bins,
+            binLabels,
+            self._weightedMeans(binColors, counts, binLabels, len(boxes)),
+        )
+
+    def cluster_colors_octree(
+        self,
+    ) -> "tuple[np.ndarray, np.ndarray]":
         """
-        Resets the existing image with the stored original image for easier testing of variants
+        Quantizes the image with octree color reduction over the occupied bins of the color histogram. Each level of the
+        octree keeps one more bit of every channel. Starting from the deepest level, the nodes with the fewest pixels have
+        their children merged until there are self.num_colors leaves, or one per bin if there are fewer bins. Only the lightest
+        children of the last merged node are merged when all of them would leave fewer leaves. The palette is the mean color of
+        each leaf.
+        Deterministic and non-iterative. The octree is built from RGB bits so this always works in RGB regardless of self.colorSpace.
+
+        Returns:
+            (palette, labels)
+
+            palette: A (N, 3) numpy array representing the quantized colors in a float32 format.
+            labels: A (H*W,) numpy array which holds the assigned labels for each pixel in the image.
         """
 
-        self.setImage(self.originalImage.copy())
+        bits = self.histogramBits
+        binIndices, bins, counts, binColors = self.getColorHistogram(self.img1d, bits)
 
-    def showImg(self, img=None, title="", figsize=(12, 12)):
+        mask = (1 << bits) - 1
+        channels = np.stack(
+            [(bins >> (2 * bits)) & mask, (bins >> bits) & mask, bins & mask], axis=1
+        )
+
+        def nodeKeys(level):
+            # Pack the top `level` bits of each channel into one key per bin
+            prefix = channels >> (bits - level)
+            return (
+                (prefix[:, 0] << (2 * level)) | (prefix[:, 1] << level) | prefix[:, 2]
+            )
+
+        # Every bin starts as a leaf at the deepest level
+        leafLevels = np.full(bins.shape[0], bits)
+        leafKeys = nodeKeys(bits)
+        numLeaves = bins.shape[0]
+
+        for level in range(bits, 0, -1):
+            if numLeaves <= self.num_colors:
+                break
+
+            # Group the current leaves by their parent node
+            parentKeys = nodeKeys(level - 1)
+            parents, parentIdx = np.unique(parentKeys, return_inverse=True)
+            parentWeights = np.bincount(parentIdx, weights=counts)
+            _, firstLeaf = np.unique(leafKeys, return_index=True)
+            numChildren = np.bincount(parentIdx[firstLeaf], minlength=parents.shape[0])
+
+            # Merging a parent turns its children into one leaf, merge the lightest parents first
+            order = np.argsort(parentWeights, kind="stable")
+            reductions = np.cumsum(numChildren[order] - 1)
+            numMerged = np.searchsorted(reductions, numLeaves - self.num_colors) + 1
+            merged = order[:numMerged]
+
+            mergedBins = np.isin(parentIdx, merged)
+            reduction = reductions[min(numMerged, order.shape[0]) - 1]
+
+            # Merging all children of the last parent can overshoot, the heaviest of them then stay leaves of their own
+            overshoot = reduction - (numLeaves - self.num_colors)
+            if overshoot > 0:
+                inLast = parentIdx == merged[-1]
+                childKeys, childIdx = np.unique(leafKeys[inLast], return_inverse=True)
+                childWeights = np.bincount(childIdx.reshape(-1), weights=counts[inLast])
+                kept = childKeys[np.argsort(childWeights, kind="stable")[-overshoot:]]
+                mergedBins[inLast] = ~np.isin(leafKeys[inLast], kept)
+
+            leafLevels[mergedBins] = level - 1
+            leafKeys = np.where(mergedBins, parentKeys, leafKeys)
+            numLeaves -= min(reduction, numLeaves - self.num_colors)
+
+            # Only part of this level had to be merged, so there are now self.num_colors leaves
+            if numMerged < order.shape[0]:
+                break
+
+        # Leaves are identified by both their level and key
+        _, binLabels = np.unique(
+            np.stack([leafLevels, leafKeys], axis=1), axis=0, return_inverse=True
+        )
+        binLabels = binLabels.reshape(-1)
+        numLeaves = binLabels.max() + 1
+
+        return self._quantizeBins(
+            binIndices,
+            bins,
+            binLabels,
+            self._weightedMeans(binColors, counts, binLabels, numLeaves),
+        )
+
+    def cluster_colors_pyramid(
+        self,
+    ) -> "tuple[np.ndarray, np.ndarray]":
         """
-        A utility function to show the current image
+        Coarse to fine quantization. The image is halved with cv2.pyrDown until it has at most self.sampleSize pixels and
+        K means is fit on that level. The coarse centers then seed Lloyd steps over the pixels at the working resolution,
+        which stop once no center moves by more than half a color level or after self.maxRefineIterations steps.
+        The number of refinement steps used is stored in self.refineIterations.
 
-        Arguments:
-            title: The title for the plot
-            figsize: The figure size of the image
+        Returns:
+            (palette, labels)
+
+            palette: A (N, 3) numpy array representing the quantized colors in a float32 format.
+            labels: A (H*W,) numpy array which holds the assigned labels for each pixel in the image.
         """
 
-        displayImage = None
-        if img is None:
-            displayImage = self.getImage()
-        else:
-            displayImage = img
+        coarse = self.image
+        while coarse.shape[0] * coarse.shape[1] > self.sampleSize:
+            coarse = cv2.pyrDown(coarse)
 
-        plt.figure(figsize=figsize)
-        plt.imshow(displayImage)
-        plt.title(title)
-        plt.show()
+        model = KMeans(
+            n_clusters=self.num_colors, n_init="auto", random_state=random_state
+        )
+        model.fit(self.toClusteringSpace(self.get1DImg(coarse)))
+        centers = model.cluster_centers_.astype(np.float32)
+
+        pixels = self.toClusteringSpace(self.img1d)
+        ones = np.ones(pixels.shape[0])
+        self.refineIterations = 0
+        for _ in range(self.maxRefineIterations):
+            labels = self.assignLabels(pixels, centers)
+            self.refineIterations += 1
+
+            newCenters = self._weightedMeans(pixels, ones, labels, centers.shape[0])
+            # Keep the old center for any cluster that lost all of its pixels
+            empty = np.bincount(labels, minlength=centers.shape[0]) == 0
+            newCenters[empty] = centers[empty]
+
+            shift = np.max(np.abs(newCenters - centers))
+            centers = newCenters
+            if shift < 0.5:
+                break
+
+        print(
+            f"Pyramid quantization used {self.refineIterations} refinement iterations"
+        )
 
-    def get1DImg(self, image: np.ndarray) -> np.ndarray:
+        self.palette = self.fromClusteringSpace(centers).astype(np.float32) / 255
+        # Lookup tables built for a previous palette no longer apply
+        self.paletteLookups = {}
+        self.labels = self.assignLabels(pixels, centers)
+        return self.palette, self.labels
+
+    def _weightedMeans(
+        self,
+        colors: np.ndarray,
+        weights: np.ndarray,
+        labels: np.ndarray,
+        numLabels: int,
+    ) -> np.ndarray:
         """
-        Vectorizes a given image of shape (H, W, C) to shape (H*W, C)
+        Gets the weighted mean color of each label
 
         Arguments:
-            image: The image to vectorize to 1 dimension
+            colors: A (M, 3) numpy array of colors
+            weights: A (M,) numpy array of weights for each color
+            labels: A (M,) numpy array with the label of each color
+            numLabels: The number of labels
 
         Returns:
-            A reshaped image vectorized over the channel axis.
+            means: A (numLabels, 3) float32 numpy array of mean colors
         """
 
-        H, W, C = image.shape
-        return image.reshape((H * W, C))
+        totals = np.bincount(labels, weights=weights, minlength=numLabels)
+        means = np.stack(
+            [
+                np.bincount(labels, weights=weights * colors[:, c], minlength=numLabels)
+                for c in range(3)
+            ],
+            axis=1,
+        )
+        return (means / totals[:, np.newaxis]).astype(np.float32)
 
-    def setImage(self, img: np.ndarray):
+    def _quantizeBins(
+        self,
+        binIndices: np.ndarray,
+        bins: np.ndarray,
+        binLabels: np.ndarray,
+        centers: np.ndarray,
+    ) -> "tuple[np.ndarray, np.ndarray]":
         """
-        Updates the currently stored image to img and updates the img1d class variable
+        Labels every pixel through a lookup table from histogram bins to clusters and sets self.palette and self.labels
 
         Arguments:
-            img: The image that should replace the existing image. Will also update the 1d representation accordingly, but not clustering or other variables.
+            binIndices: A (H*W,) numpy array with the histogram bin of each pixel, see getColorHistogram()
+            bins: A (M,) numpy array of the occupied bins
+            binLabels: A (M,) numpy array with the cluster of each occupied bin
+            centers: A (N, 3) numpy array with the color of each cluster in the range 0-255
+
+        Returns:
+            (palette, labels) in the same format as the quantizers in PbnGen.QUANTIZERS
         """
 
-        self.image = img.copy()
-        self.img1d = self.get1DImg(self.image)
+        # Map every possible bin to a cluster, only the occupied ones are ever looked up
+        binLookup = np.zeros(1 << (3 * self.histogramBits), dtype=np.int32)
+        binLookup[bins] = binLabels
 
-    def getImage(self) -> np.ndarray:
+        self.palette = centers.astype(np.float32) / 255
+        # Lookup tables built for a previous palette no longer apply
+        self.paletteLookups = {}
+        self.labels = binLookup[binIndices]
+        return self.palette, self.labels
+
+    @staticmethod
+    def getColorHistogram(
+        pixels: np.ndarray, bits: int = 5
+    ) -> "tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]":
         """
-        Returns a copy of the current image that can be stored or modified
+        Builds a sparse color histogram by packing the top bits of each RGB channel into a single integer bin index.
+
+        Arguments:
+            pixels: A (H*W, 3) uint8 numpy array of pixels
+            bits: How many of the most significant bits of each channel are kept. 5 bits gives 32^3 possible bins
 
         Returns:
-            copy: A copy of the current self.image
+            (binIndices, bins, counts, binColors)
+
+            binIndices: A (H*W,) numpy array with the packed bin index of every pixel
+            bins: A (M,) numpy array of the occupied bin indices
+            counts: A (M,) numpy array with the number of pixels in each occupied bin
+            binColors: A (M, 3) float32 numpy array with the mean color of the pixels in each occupied bin
         """
 
-        return self.image.copy()
+        shift = 8 - bits
+        binIndices = (
+            ((pixels[:, 0].astype(np.int32) >> shift) << (2 * bits))
+            | ((pixels[:, 1].astype(np.int32) >> shift) << bits)
+            | (pixels[:, 2].astype(np.int32) >> shift)
+        )
 
-    def getImageArea(self) -> int:
+        numBins = 1 << (3 * bits)
+        allCounts = np.bincount(binIndices, minlength=numBins)
+        bins = np.flatnonzero(allCounts)
+        counts = allCounts[bins]
+
+        # Use the mean color of each bin rather than its corner so quantization error inside the bin doesn't shift the palette
+        binColors = np.stack(
+            [
+                np.bincount(binIndices, weights=pixels[:, c], minlength=numBins)[bins]
+                for c in range(3)
+            ],
+            axis=1,
+        )
+        binColors = (binColors / counts[:, np.newaxis]).astype(np.float32)
+
+        return binIndices, bins, counts, binColors
+
+    def getStratifiedSample(self, image: np.ndarray, maxSamples: int) -> np.ndarray:
         """
-        Returns the image area
+        Gets a spatially stratified sample of pixels by splitting the image into a regular grid of cells and taking one
+        randomly offset pixel per cell. Unlike a uniform random sample, every part of the image is represented.
+
+        Arguments:
+            image: An (H, W, C) image to sample from
+            maxSamples: The maximum number of pixels to return
 
         Returns:
-            area: H*W for an image of shape (H, W, C)
+            sample: A (N, C) numpy array of sampled pixels where 1 <= N <= maxSamples
         """
 
-        H, W, C = self.image.shape
-        return H * W
-
-    def resizeImage(
-        self, image=None, scale: float = 1, dimension: tuple = None
-    ) -> None:
+        H, W, C = image.shape
+        if H * W <= maxSamples:
+            return image.reshape((H * W, C))
+
+        # Cells are roughly square, but each axis gets its own stride so long thin images neither run past maxSamples nor
+        # draw an offset beyond their last row or column
+        strideY = int(np.ceil(np.sqrt(H * W / maxSamples)))
+        strideY = min(max(strideY, int(np.ceil(H / maxSamples))), H)
+        rows = int(np.ceil(H / strideY))
+        strideX = min(int(np.ceil(W / (maxSamples // rows))), W)
+
+        rng = np.random.default_rng(random_state)
+        offsetY = rng.integers(0, strideY)
+        offsetX = rng.integers(0, strideX)
+        sample = image[offsetY::strideY, offsetX::strideX]
+        return sample.reshape((-1, C))
+
+    def assignLabels(
+        self, pixels: np.ndarray, centers: np.ndarray, chunkSize: int = 65536
+    ) -> np.ndarray:
         """
-        Return a resized version of the provided image or self.image if image=None.
+        Assigns every pixel to its nearest center. Works through the pixels in chunks so only a (chunkSize, N) float32 distance
+        matrix is held in memory at a time instead of a float64 copy of the whole image.
 
         Arguments:
-            scale: A float > 0 that is used to scale the image up or down with a scale of 1 returning the same image.
-            dimension=None: A tuple representing the manual size the image should be in the form (H, W). Overrides any given scale value.
-        """
+            pixels: A (H*W, 3) numpy array of pixels
+            centers: A (N, 3) numpy array of cluster centers in the same color range as pixels
+            chunkSize: How many pixels are assigned per vectorized step
 
-        assert scale > 0, f"Given scale {scale} must be greater than 0!"
+        Returns:
+            labels: A (H*W,) int32 numpy array with the index of the nearest center for each pixel
+        """
 
-        img = None
-        if image is None:
-            img = self.getImage().astype(np.uint8)
-        else:
-            img = image
+        centers = centers.astype(np.float32)
+        # |x - c|^2 = |x|^2 - 2x.c + |c|^2 and |x|^2 is the same for every center so it can be dropped for the argmin
+        centerNorms = np.sum(centers**2, axis=1)
+        labels = np.empty(pixels.shape[0], dtype=np.int32)
 
-        H, W = 0, 0
+        for start in range(0, pixels.shape[0], chunkSize):
+            chunk = pixels[start : start + chunkSize].astype(np.float32)
+            distances = centerNorms - 2 * chunk @ centers.T
+            labels[start : start + chunkSize] = np.argmin(distances, axis=1)
 
-        if img.ndim == 3:
-            H, W, C = img.shape
-        elif img.ndim == 2:
-            H, W = img.shape
+        return labels
 
-        resized = None
+    def buildPaletteLookup(self, centers: np.ndarray, bits: int = 6) -> np.ndarray:
+        """
+        Builds a 3D lookup table that maps a color to the index of its nearest palette color. Each channel is truncated to its
+        top `bits` bits and every cell holds the nearest palette color to the center of that cell. Only has to be built once per
+        palette and can then label any number of images.
 
-        if dimension is not None:
-            NH, NW = dimension
+        Arguments:
+            centers: A (N, 3) numpy array of palette colors in the range 0-255
+            bits: Bits per channel of the table. 6 bits gives a 64x64x64 table, 8 bits gives an exact 256x256x256 table
 
-            # If upsampling, use INTER_NEAREST, otherwise, use INTER_AREA. We want to use INTER_NEAREST for upsampling to preserve the number of colors
-            if (
-                NH * NW >= H * W
-            ):  # This is a crude estimate for up vs downsampling, but it works well enough
-                resized = cv2.resize(img, (NW, NH), interpolation=cv2.INTER_NEAREST)
-            else:
-                resized = cv2.resize(img, (NW, NH), interpolation=cv2.INTER_AREA)
-        else:
-            NH, NW = int(H * scale), int(W * scale)
+        Returns:
+            lookup: A (2^bits, 2^bits, 2^bits) uint8 numpy array of palette indices, or uint16 for more than 256 colors
+        """
 
-            if scale <= 1:
-                resized = cv2.resize(img, (NW, NH), interpolation=cv2.INTER_AREA)
-            else:
-                resized = cv2.resize(img, (NW, NH), interpolation=cv2.INTER_NEAREST)
+        size = 1 << bits
+        grid = self._lookupGrid(bits)
 
-        return resized
+        dtype = np.uint8 if centers.shape[0] <= 256 else np.uint16
+        return (
+            self.assignLabels(grid, centers).astype(dtype).reshape((size, size, size))
+        )
 
-    def resizeImage_(self, scale: float = 1, dimension: tuple = None) -> None:
+    def _lookupGrid(self, bits: int) -> np.ndarray:
         """
-        Resize the stored image in place by some scale factor.
+        Gets the center color of every cell of a palette lookup table
 
         Arguments:
-            scale: A float > 0 that is used to scale the image up or down with a scale of 1 returning the same image.
-            dimension=None: A tuple representing the manual size the image should be in the form (H, W). Overrides any given scale value.
+            bits: Bits per channel of the table
+
+        Returns:
+            grid: A (2^(3*bits), 3) float32 numpy array of colors in the same order as the flattened table
         """
 
-        resized = self.resizeImage(scale=scale, dimension=dimension)
+        step = 1 << (8 - bits)
+        cellCenters = np.arange(1 << bits, dtype=np.float32) * step + (step - 1) / 2
 
-        self.setImage(resized)
+        r, g, b = np.meshgrid(cellCenters, cellCenters, cellCenters, indexing="ij")
+        return np.stack([r.reshape(-1), g.reshape(-1), b.reshape(-1)], axis=1)
 
-    def blurImage_(
-        self,
-        blurType: str,
-        ksize: int = 13,
-        sigma: float = 3,
-        sigmaColor: float = 21,
-        sigmaSpace: float = 21,
-    ) -> None:
+    def lookupLabels(self, image: np.ndarray, lookup: np.ndarray) -> np.ndarray:
         """
-        Blurs the current image in place according to the arguments of the function.
-        Updates self.image and self.img1d
+        Labels every pixel of an image with a lookup table from buildPaletteLookup() in a single gather
 
         Arguments:
-            blurType: 'gaussian', 'median', or 'bilateral'. Determines the kind of filter to be applied
-            ksize: The size of the blurring kernel to be applied
-            sigma: A sigma for the gaussian kernel type
-            sigmaColor: How large of a range colors should be blended, higher values means more distant colors will be blended
-            sigmaSpace: How intensely pixels in the kernel are blurred
-        """
-
-        image = self.image.astype(np.uint8)
-        blurred = None
+            image: A (H, W, 3) uint8 RGB image
+            lookup: A lookup table from buildPaletteLookup()
 
-        if blurType == "gaussian":
-            kernel = cv2.getGaussianKernel(ksize=ksize, sigma=sigma)
-            blurred = cv2.filter2D(image, ddepth=-1, kernel=kernel)
-            blurred = cv2.filter2D(image, ddepth=-1, kernel=kernel.T)
-        elif blurType == "median":
-            blurred = cv2.medianBlur(image, ksize=ksize)
-        elif blurType == "bilateral":
-            blurred = cv2.bilateralFilter(
-                image, d=ksize, sigmaColor=sigmaColor, sigmaSpace=sigmaSpace
-            )
+        Returns:
+            labels: A (H, W) numpy array of palette indices with the same dtype as lookup
+        """
 
-        self.image = blurred
-        self.img1d = self.get1DImg(self.image)
+        shift = 8 - int(np.log2(lookup.shape[0]))
+        return lookup[
+            image[..., 0] >> shift, image[..., 1] >> shift, image[..., 2] >> shift
+        ]
 
-    def getUniqueColors(self, image=None) -> np.ndarray:
+    def requantize(self, image: np.ndarray = None) -> np.ndarray:
         """
-        Gets an array of shape (N, 3) which represents all the unique colors present in self.image
+        Maps an image onto the current palette, for example the original image after the palette was fit on a downscaled
+        copy. The original is only full resolution when it was decoded with reducedDecode=False. See getPaletteLookup() for
+        how pixels are assigned.
 
         Arguments:
-            image=None: If None, returns the unique colors of self.image, otherwise, performs the operations for the provided image.
+            image: An (H, W, 3) uint8 RGB image. Uses self.originalImage if None
 
         Returns:
-            uniqueColors: A (N, 3) numpy array which represents the found unique colors in the provided or current image.
+            q_img: An (H, W, 3) uint8 image where every pixel is replaced by its nearest palette color
         """
 
-        reshaped_image = None
         if image is None:
-            # Reshape to a 2D array
-            reshaped_image = self.image.reshape(-1, self.image.shape[2])
-        else:
-            reshaped_image = image.reshape(-1, image.shape[2])
+            assert (
+                self.originalImage is not None
+            ), "The original image wasn't kept, pass an image or set keepOriginal=True"
+            image = self.originalImage
 
-        # Find unique color values across the channels
-        uniqueColors = np.unique(reshaped_image, axis=0)
-
-        return uniqueColors
+        # Same conversion cluster_colors_() uses so the colors match the working image
+        colors = self.toUint8(self.palette * 255)
+        return colors[self.lookupLabels(image, self.getPaletteLookup())]
 
-    def getUniqueColorsMasks(self) -> dict:
+    def getPaletteLookup(self) -> np.ndarray:
         """
-        Returns a dictionary with indices of each unique color and a binary numpy array representing where each unique color is
-        a key and each value is a binary mask of the image representing where that color is.
+        Gets the RGB -> palette index lookup table of the current palette, building it on first use. Distances are measured in
+        CIELAB when clustering in CIELAB or mapping onto a fixed palette and in RGB otherwise, so the table assigns pixels the
+        same way the quantizer did. Tables are cached in self.paletteLookups by color space until the palette changes.
 
         Returns:
-            colorsDict: A dictionary with keys of RGB tuples and values of binary masks representing the presence of that key in the image
+            lookup: A (2^lookupBits, 2^lookupBits, 2^lookupBits) numpy array of palette indices, see buildPaletteLookup()
         """
 
-        colorsDict = {}
+        space = (
+            "lab" if self.colorSpace == "lab" or self.quantizer == "fixed" else "rgb"
+        )
+        if space not in self.paletteLookups:
+            build = (
+                self.buildPaletteLookupLab
+                if space == "lab"
+                else self.buildPaletteLookup
+            )
+            self.paletteLookups[space] = build(self.palette * 255, self.lookupBits)
 
-        uniqueColors = self.getUniqueColors()
+        return self.paletteLookups[space]
 
-        for color in uniqueColors:
-            colorsDict[tuple(color)] = np.repeat(
-                np.all(self.image == color, axis=2)[..., np.newaxis], repeats=3, axis=2
-            )
+    def cluster_colors_fixed(self) -> "tuple[np.ndarray, np.ndarray]":
+        """
+        Maps every pixel onto its perceptually nearest color of the fixed palette given to the constructor without any clustering.
+        Uses a palette lookup table built from a KD-tree over the palette in CIELAB, which is cached per palette so processing
+        many images with the same paint kit only builds it once.
 
-        self.colorMasks = colorsDict
+        Returns:
+            (palette, labels)
 
-        return colorsDict
+            palette: A (N, 3) numpy array representing the quantized colors in a float32 format.
+            labels: A (H*W,) numpy array which holds the assigned labels for each pixel in the image.
+        """
+
+        key = (self.fixedPalette.tobytes(), self.lookupBits)
+        if key not in palette_lookup_cache:
+            palette_lookup_cache[key] = self.buildPaletteLookupLab(
+                self.fixedPalette, self.lookupBits
+            )
 
-    def generatePrunableClusters(self, showPlots=False):
+        self.palette = self.fixedPalette.astype(np.float32) / 255
+        self.paletteLookups = {"lab": palette_lookup_cache[key]}
+        self.labels = self.lookupLabels(self.image, self.getPaletteLookup()).reshape(-1)
+        return self.palette, self.labels
+
+    def loadPalette(self, palette) -> np.ndarray:
         """
-        Stores color masks in self.prunableClusters which can be pruned from the main image. The small pruned clusters can be replaced by the nearest color
-        in the original image in a different function. The treshold used to determine which clusters should be removed is defined as self.pruningThreshold
+        Loads a predefined palette
 
         Arguments:
-            showPlots=False: Whether or not to show plots of pruned clusters
-        """
+            palette: Either the name of a kit in paint_kits, a path to a JSON file holding a list of [R, G, B] colors,
+                or a list or array of RGB colors
 
-        colorsDict = self.getUniqueColorsMasks()
+        Returns:
+            palette: A (N, 3) uint8 numpy array of RGB colors
+        """
 
-        prunableClusters = {}
+        if isinstance(palette, str):
+            if palette in paint_kits:
+                palette = paint_kits[palette]
+            else:
+                with open(palette) as infile:
+                    palette = json.load(infile)
 
-        for color in colorsDict.keys():
-            mask = colorsDict[color]
+        palette = np.array(palette, dtype=np.uint8).reshape((-1, 3))
+        assert palette.shape[0] > 0, "The palette must contain at least one color"
+        return palette
 
-            # Convert color tuple to an array
-            color = np.array(color, dtype=np.uint8)
-            singleColorImage = color * mask
+    def buildPaletteLookupLab(self, colors: np.ndarray, bits: int = 6) -> np.ndarray:
+        """
+        Same as buildPaletteLookup(), but the nearest palette color of each cell is found with a KD-tree over the palette in
+        CIELAB so colors are matched by how similar they look rather than by RGB distance.
 
-            if showPlots:
-                plt.imshow(singleColorImage), plt.title(color)
-                plt.show()
+        Arguments:
+            colors: A (N, 3) numpy array of palette colors in the range 0-255
+            bits: Bits per channel of the table
 
-            # The mask seems to need to be a "binary" image but the binary values are 0 and 255 instead of 0 and 1
-            (
-                numLabels,
-                labels,
-                stats,
-                centroids,
-            ) = cv2.connectedComponentsWithStatsWithAlgorithm(
-                (mask[..., 0] * 255).astype(np.uint8), 8, cv2.CV_32S, cv2.CCL_WU
-            )
+        Returns:
+            lookup: A (2^bits, 2^bits, 2^bits) uint8 numpy array of palette indices, or uint16 for more than 256 colors
+        """
 
-            if showPlots:
-                plt.imshow(labels), plt.title("Before pruning")
-                plt.show()
+        size = 1 << bits
+        grid = self._lookupGrid(bits)
 
-            labelIndices = np.arange(1, numLabels)
-            areas = stats[labelIndices, -1]
+        tree = KDTree(self.rgbToLab(colors))
+        _, nearest = tree.query(self.rgbToLab(grid), k=1)
 
-            imageArea = self.getImageArea()
-            # Get an array representing the clusters that are too small and should be pruned
-            tooSmall = imageArea * self.pruningThreshold > areas
-            # Negatable is an array containing the labels that should be pruned, these are then negated in the labels mask
-            negatable = labelIndices[tooSmall]
-            negateMask = np.isin(labels, negatable)
-            labels[negateMask] *= -1
+        dtype = np.uint8 if colors.shape[0] <= 256 else np.uint16
+        return nearest.reshape(-1).astype(dtype).reshape((size, size, size))
 
-            # Convert from labels to a mask where each pruned cluster has its unique segmented label
-            labels[labels > 0] = 0
-            labels = -labels
+    def cluster_colors_(self):
+        """
+        An in-place clustering of colors, replaces existing image with the quantized version as an index image, see setIndexImage()
+        """
+
+        palette, labels = getattr(self, self.QUANTIZERS[self.quantizer])()
+
+        # The quantized image is kept as palette indices, RGB is only materialized when something reads self.image
+        self.setIndexImage(
+            labels.reshape(self.getImageSize()), self.toUint8(palette * 255)
+        )
+
+    def get_num_clusters(self, max_test: int = 25, patience: int = 3):
+        """
+        Algorithmically gets optimal number of clusters for k means using knee method.
+        The sample is drawn once and each k is warm started from the k-1 centroids plus one new k means++ style center,
+        so every fit only needs a few Lloyd iterations. After each fit the untested part of the inertia curve is extrapolated
+        from how quickly the inertia drops are shrinking, and the search stops once the knee of that curve has stayed the same
+        for patience consecutive values of k instead of always testing every k up to max_test.
+
+        Arguments:
+            max_test: One more than the largest number of clusters that will be tested
+            patience: How many extra values of k the knee must stay unchanged for before the search stops
+
+        Returns:
+            numClusters: The optimal number of clusters found by the K Knee method
+        """
+
+        num_samples = 10000
+        # run on sample to save time for approximation
+        image_arr_sample = shuffle(
+            self.img1d,
+            random_state=0,
+            n_samples=min(num_samples, self.img1d.shape[0]),
+        ).astype(np.float32)
+        rng = np.random.default_rng(random_state)
+
+        x_vals = np.arange(1, max_test)
+        inertias = []
+        centers = image_arr_sample.mean(axis=0, keepdims=True)
+        knee = None
+        stableFor = 0
+        for i in x_vals:
+            if i > 1:
+                # Add one center with probability proportional to the squared distance from the existing centers
+                distances = np.min(
+                    np.sum(
+                        (image_arr_sample[:, np.newaxis] - centers[np.newaxis]) ** 2,
+                        axis=2,
+                    ),
+                    axis=1,
+                )
+                if distances.sum() == 0:
+                    # Every sampled pixel is already a center, more clusters can't lower the inertia
+                    break
+                newCenter = image_arr_sample[
+                    rng.choice(distances.shape[0], p=distances / distances.sum())
+                ]
+                centers = np.vstack([centers, newCenter])
+
+            kmeans = KMeans(n_clusters=i, init=centers, n_init=1)
+            kmeans.fit(image_arr_sample)
+            centers = kmeans.cluster_centers_.astype(np.float32)
+            inertias.append(kmeans.inertia_)
+
+            # At least three drops are needed to estimate how the curve continues
+            if i < 4:
+                continue
+
+            kn = KneeLocator(
+                x=x_vals,
+                y=self._extrapolateInertias(inertias, len(x_vals)),
+                curve="convex",
+                direction="decreasing",
+            )
+            if kn.knee is not None and kn.knee == knee:
+                stableFor += 1
+            else:
+                stableFor = 0
+            knee = kn.knee
+
+            if knee is not None and stableFor >= patience:
+                break
+
+        # plt.plot(x_vals, inertias)
+        # plt.show()
+
+        print(f"Knee search tested {len(inertias)} cluster counts")
+        return int(knee) if knee is not None else len(inertias)
+
+    def _extrapolateInertias(self, inertias: list, length: int) -> np.ndarray:
+        """
+        Extends a partial inertia curve to the given length by assuming each further drop shrinks by the same ratio as the last
+        observed drops. The knee is sensitive to the range of the curve it's measured on, so this lets a partial search find the
+        same knee as a search over every k.
+
+        Arguments:
+            inertias: The inertias for k = 1, 2, ... that have been measured so far. Needs at least 4 values
+            length: The length of the extrapolated curve
+
+        Returns:
+            curve: A (length,) numpy array starting with the measured inertias
+        """
+
+        drops = -np.diff(inertias)
+        ratio = np.clip(np.mean(drops[-2:] / np.maximum(drops[-3:-1], 1e-9)), 0, 0.95)
+
+        curve = list(inertias)
+        drop = drops[-1]
+        while len(curve) < length:
+            drop *= ratio
+            curve.append(curve[-1] - drop)
+
+        return np.array(curve[:length])
+
+    def get_num_clusters_histogram(self, max_colors: int = 24) -> int:
+        """
+        Gets the number of colors from a median cut of the image's color histogram in CIELAB. Boxes are split until the average
+        distance between a pixel's binned color and the mean color of its box is at most self.maxDeltaE. A delta E of about 2 is
+        barely noticeable, so this gives a threshold that is easier to reason about than a knee. Only the occupied histogram bins
+        are processed so this takes milliseconds regardless of image size.
+
+        Arguments:
+            max_colors: The largest number of colors that can be returned
+
+        Returns:
+            numClusters: The number of median cut boxes needed to reach self.maxDeltaE
+        """
+
+        _, _, counts, binColors = self.getColorHistogram(self.img1d, bits=5)
+        labColors = self.rgbToLab(binColors)
+
+        boxes, distortions = self.medianCut(
+            labColors, counts, max_colors, maxDistortion=self.maxDeltaE
+        )
+        print(f"Median cut reached a delta E of {distortions[-1]:.2f}")
+
+        return len(boxes)
+
+    @staticmethod
+    def rgbToLab(colors: np.ndarray) -> np.ndarray:
+        """
+        Converts an array of RGB colors in the range 0-255 to CIELAB
+
+        Arguments:
+            colors: A (N, 3) numpy array of RGB colors
+
+        Returns:
+            labColors: A (N, 3) float32 numpy array of colors with L in 0-100 and a, b in about -128-127
+        """
+
+        rgb = (colors.astype(np.float32) / 255).reshape((-1, 1, 3))
+        return cv2.cvtColor(rgb, cv2.COLOR_RGB2LAB).reshape((-1, 3))
+
+    @staticmethod
+    def labToRgb(colors: np.ndarray) -> np.ndarray:
+        """
+        Converts an array of CIELAB colors back to RGB
+
+        Arguments:
+            colors: A (N, 3) numpy array of colors with L in 0-100
+
+        Returns:
+            rgbColors: A (N, 3) float32 numpy array of RGB colors in the range 0-255
+        """
+
+        lab = colors.astype(np.float32).reshape((-1, 1, 3))
+        rgb = cv2.cvtColor(lab, cv2.COLOR_LAB2RGB).reshape((-1, 3))
+        return np.clip(rgb * 255, 0, 255)
+
+    def toClusteringSpace(self, colors: np.ndarray) -> np.ndarray:
+        """
+        Converts RGB colors to self.colorSpace for clustering. The conversion to CIELAB is a single vectorized float32 call.
+
+        Arguments:
+            colors: A (N, 3) numpy array of RGB colors in the range 0-255
+
+        Returns:
+            converted: A (N, 3) float32 numpy array. RGB colors are returned in the range 0-255
+        """
+
+        if self.colorSpace == "lab":
+            return self.rgbToLab(colors)
+        # sklearn keeps float32 input as float32 instead of upcasting uint8 pixels to float64
+        return colors.astype(np.float32)
+
+    def fromClusteringSpace(self, colors: np.ndarray) -> np.ndarray:
+        """
+        Converts colors from self.colorSpace back to RGB
+
+        Arguments:
+            colors: A (N, 3) numpy array of colors in self.colorSpace
+
+        Returns:
+            rgbColors: A (N, 3) numpy array of RGB colors in the range 0-255
+        """
+
+        if self.colorSpace == "lab":
+            return self.labToRgb(colors)
+        return colors
+
+    def medianCut(
+        self,
+        colors: np.ndarray,
+        weights: np.ndarray,
+        maxBoxes: int,
+        maxDistortion: float = 0,
+    ) -> "tuple[list, list]":
+        """
+        Weighted median cut. Repeatedly splits the box with the largest total color error at the weighted median of its
+        highest variance axis until there are maxBoxes boxes or the average error is at most maxDistortion.
+
+        Arguments:
+            colors: A (M, 3) numpy array of colors, usually the occupied bins of a histogram
+            weights: A (M,) numpy array with how many pixels each color represents
+            maxBoxes: The largest number of boxes to split the colors into
+            maxDistortion: Stop splitting once the weighted average distance from each color to its box mean is at most this
+
+        Returns:
+            (boxes, distortions)
+
+            boxes: A list of numpy arrays holding the indices into colors of the members of each box
+            distortions: The weighted average distance to the box means after each split, starting with a single box
+        """
+
+        colors = colors.astype(np.float32)
+        weights = weights.astype(np.float64)
+        totalWeight = weights.sum()
+
+        def boxError(indices):
+            boxWeights = weights[indices]
+            mean = np.average(colors[indices], axis=0, weights=boxWeights)
+            return np.sum(boxWeights * np.linalg.norm(colors[indices] - mean, axis=1))
+
+        boxes = [np.arange(colors.shape[0])]
+        errors = [boxError(boxes[0])]
+        distortions = [errors[0] / totalWeight]
+
+        while len(boxes) < maxBoxes and distortions[-1] > maxDistortion:
+            # Boxes with a single color can't be split any further
+            candidates = [i for i in range(len(boxes)) if boxes[i].shape[0] > 1]
+            if not candidates:
+                break
+            splitIdx = max(candidates, key=lambda i: errors[i])
+            indices = boxes[splitIdx]
+
+            boxColors = colors[indices]
+            boxWeights = weights[indices]
+            mean = np.average(boxColors, axis=0, weights=boxWeights)
+            variance = np.average((boxColors - mean) ** 2, axis=0, weights=boxWeights)
+            axis = np.argmax(variance)
+
+            order = np.argsort(boxColors[:, axis], kind="stable")
+            cumulative = np.cumsum(boxWeights[order])
+            median = np.searchsorted(cumulative, cumulative[-1] / 2)
+            # Keep at least one color on each side of the cut
+            median = int(np.clip(median + 1, 1, order.shape[0] - 1))
+
+            low, high = indices[order[:median]], indices[order[median:]]
+            boxes[splitIdx] = low
+            errors[splitIdx] = boxError(low)
+            boxes.append(high)
+            errors.append(boxError(high))
+            distortions.append(sum(errors) / totalWeight)
+
+        return boxes, distortions
+
+    def plt_cluster_pie(self):
+        """
+        Plots a pie chart based on the percentage of each color in the image
+        """
+
+        unique_values, counts = np.unique(self.labels, return_counts=True)
+        percentages = (counts / len(self.labels)) * 100
+        plt.pie(
+            percentages,
+            colors=np.array(self.palette),
+            labels=np.arange(len(self.palette)),
+        )
+        plt.show()
+
+    def resetImage(self):
+        """
+        Resets the existing image with the stored original image for easier testing of variants
+        """
+
+        assert (
+            self.originalImage is not None
+        ), "The original image wasn't kept, set keepOriginal=True to reset the image"
+        self.setImage(self.originalImage)
+
+    def showImg(self, img=None, title="", figsize=(12, 12)):
+        """
+        A utility function to show the current image
+
+        Arguments:
+            title: The title for the plot
+            figsize: The figure size of the image
+        """
+
+        displayImage = None
+        if img is None:
+            displayImage = self.getImage()
+        else:
+            displayImage = img
+
+        plt.figure(figsize=figsize)
+        plt.imshow(displayImage)
+        plt.title(title)
+        plt.show()
+
+    def get1DImg(self, image: np.ndarray) -> np.ndarray:
+        """
+        Vectorizes a given image of shape (H, W, C) to shape (H*W, C)
+
+        Arguments:
+            image: The image to vectorize to 1 dimension
+
+        Returns:
+            A reshaped image vectorized over the channel axis.
+        """
+
+        H, W, C = image.shape
+        return image.reshape((H * W, C))
+
+    @property
+    def image(self) -> np.ndarray:
+        """
+        The current (H, W, 3) RGB image. After quantization the working image is stored as self.indexImage and self.indexColors
+        instead, and the RGB image is only materialized and cached the first time it is read
+        """
+
+        if self._image is None and self.indexImage is not None:
+            self._image = self.indexColors[self.indexImage]
+        return self._image
+
+    @image.setter
+    def image(self, img: np.ndarray):
+        self._image = img
+        self.indexImage = None
+        self.indexColors = None
+
+    @property
+    def img1d(self) -> np.ndarray:
+        """
+        The current image vectorized to shape (H*W, 3), see get1DImg()
+        """
+
+        return self.get1DImg(self.image)
+
+    def setImage(self, img: np.ndarray, copy: bool = False):
+        """
+        Updates the currently stored image to img and updates the img1d class variable. The image takes ownership of img rather
+        than copying it, so the caller shouldn't modify img afterwards. Stages replace the image instead of writing into it, so
+        read-only arrays can be passed as well.
+
+        Arguments:
+            img: The image that should replace the existing image. Will also update the 1d representation accordingly, but not clustering or other variables.
+            copy=False: Whether to store a copy of img, for callers that keep modifying img
+        """
+
+        self.image = img.copy() if copy else img
+
+    def setIndexImage(self, indexImage: np.ndarray, colors: np.ndarray):
+        """
+        Replaces the current image with a palette index image. Every pixel holds the index of its color in colors, which takes
+        1 byte per pixel for up to 256 colors and 2 bytes otherwise, compared to 3 for an RGB image and 12 for an int32 copy.
+        The colors are sorted and deduplicated the same way getIndexImage() orders them. The index image is stored without copying
+        and stages may modify it in place, so the caller shouldn't keep using it.
+
+        Arguments:
+            indexImage: A (H, W) integer numpy array of indices into colors
+            colors: A (N, 3) numpy array of RGB colors in the range 0-255
+        """
+
+        colors = np.asarray(colors, dtype=np.uint8)
+        uniqueColors, inverse = np.unique(colors, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        assert (
+            uniqueColors.shape[0] <= 1 << 16
+        ), f"{uniqueColors.shape[0]} colors don't fit in an index image, quantize the image first"
+
+        dtype = np.uint8 if uniqueColors.shape[0] <= 256 else np.uint16
+        if indexImage.dtype != dtype or np.any(inverse != np.arange(colors.shape[0])):
+            indexImage = inverse.astype(dtype)[indexImage]
+        elif self.labels is not None and np.may_share_memory(indexImage, self.labels):
+            # self.labels stays readable for plt_cluster_pie() while the stages edit the index image in place
+            indexImage = indexImage.copy()
+
+        self._image = None
+        self.indexImage = indexImage
+        self.indexColors = uniqueColors
+
+    def toIndexImage_(self):
+        """
+        Converts the current image in place to a palette index image if it isn't one already, see setIndexImage()
+        """
+
+        if self.indexImage is None:
+            self.setIndexImage(*self.getIndexImage())
+
+    def getImage(self, copy: bool = False) -> np.ndarray:
+        """
+        Returns the current image as a read-only view, or as a copy that can be stored or modified
+
+        Arguments:
+            copy=False: Whether to return a mutable copy instead of a view
+
+        Returns:
+            image: A read-only view of the current self.image, or a copy of it
+        """
+
+        if copy:
+            return self.image.copy()
+        return self.readOnly(self.image)
+
+    def readOnly(self, array: np.ndarray) -> np.ndarray:
+        """
+        Returns a read-only view of an array, so arrays owned by the object can be handed out without copying them
+
+        Arguments:
+            array: A numpy array
+
+        Returns:
+            view: A view of array that can't be written to
+        """
+
+        view = array.view()
+        view.flags.writeable = False
+        return view
+
+    def getImageSize(self) -> "tuple[int, int]":
+        """
+        Returns the image size without materializing an RGB image from the index image
+
+        Returns:
+            (H, W): The height and width of the current image
+        """
+
+        if self.indexImage is not None:
+            return self.indexImage.shape
+        return self.image.shape[:2]
+
+    def getImageArea(self) -> int:
+        """
+        Returns the image area
+
+        Returns:
+            area: H*W for an image of shape (H, W, C)
+        """
+
+        H, W = self.getImageSize()
+        return H * W
+
+    def resizeImage(
+        self, image=None, scale: float = 1, dimension: tuple = None
+    ) -> None:
+        """
+        Return a resized version of the provided image or self.image if image=None.
+
+        Arguments:
+            scale: A float > 0 that is used to scale the image up or down with a scale of 1 returning the same image.
+            dimension=None: A tuple representing the manual size the image should be in the form (H, W). Overrides any given scale value.
+        """
+
+        assert scale > 0, f"Given scale {scale} must be greater than 0!"
+
+        img = None
+        if image is None:
+            img = self.getImage().astype(np.uint8, copy=False)
+        else:
+            img = image
+
+        H, W = 0, 0
+
+        if img.ndim == 3:
+            H, W, C = img.shape
+        elif img.ndim == 2:
+            H, W = img.shape
+
+        resized = None
+
+        if dimension is not None:
+            NH, NW = dimension
+
+            # If upsampling, use INTER_NEAREST, otherwise, use INTER_AREA. We want to use INTER_NEAREST for upsampling to preserve the number of colors
+            if (
+                NH * NW >= H * W
+            ):  # This is a crude estimate for up vs downsampling, but it works well enough
+                resized = cv2.resize(img, (NW, NH), interpolation=cv2.INTER_NEAREST)
+            else:
+                resized = cv2.resize(img, (NW, NH), interpolation=cv2.INTER_AREA)
+        else:
+            NH, NW = int(H * scale), int(W * scale)
+
+            if scale <= 1:
+                resized = cv2.resize(img, (NW, NH), interpolation=cv2.INTER_AREA)
+            else:
+                resized = cv2.resize(img, (NW, NH), interpolation=cv2.INTER_NEAREST)
+
+        return resized
+
+    def resizeImage_(self, scale: float = 1, dimension: tuple = None) -> None:
+        """
+        Resize the stored image in place by some scale factor.
+
+        Arguments:
+            scale: A float > 0 that is used to scale the image up or down with a scale of 1 returning the same image.
+            dimension=None: A tuple representing the manual size the image should be in the form (H, W). Overrides any given scale value.
+        """
+
+        if self.indexImage is not None:
+            # Index images are always resized with nearest neighbour interpolation since blending indices would make up colors
+            H, W = self.indexImage.shape
+            NH, NW = (
+                dimension if dimension is not None else (int(H * scale), int(W * scale))
+            )
+            self.setIndexImage(
+                cv2.resize(self.indexImage, (NW, NH), interpolation=cv2.INTER_NEAREST),
+                self.indexColors,
+            )
+            return
+
+        resized = self.resizeImage(scale=scale, dimension=dimension)
+
+        self.setImage(resized)
+
+    def planResolution(
+        self, maxPixels: int = None, outputSize: tuple = None, maxScale: float = 1
+    ) -> float:
+        """
+        Picks the resolution the pipeline works at and downscales the image to it in place. The working scale is the largest one
+        that is at most maxScale, fits in maxPixels and isn't larger than the output needs, see get_working_scale(). The SVG geometry is scaled from the
+        working resolution to the output size afterwards, so rasters never have to be upsampled. Prints the chosen scale and
+        the estimated savings.
+
+        Arguments:
+            maxPixels=None: The pixel budget of the working image. No limit if None
+            outputSize=None: The (H, W) box the SVG should fit in. Defaults to the size of the full resolution image
+            maxScale: The largest working scale to use, even if the image fits the budget
+
+        Returns:
+            scale: The working scale relative to the full resolution image
+        """
+
+        H, W = self.sourceSize
+        scale, outputScale = get_working_scale(
+            self.sourceSize, maxPixels, outputSize, maxScale
+        )
+
+        # The image may already be smaller than the full resolution from a reduced decode, which rounds its size up. A pixel of
+        # rounding isn't worth resampling the whole image for
+        h, w = self.getImageSize()
+        NH, NW = max(int(H * scale), 1), max(int(W * scale), 1)
+        if h - NH > 1 or w - NW > 1:
+            self.resizeImage_(dimension=(NH, NW))
+
+        # The SVG size comes from the full resolution size, since the working size is rounded on each axis separately.
+        # outputScale, used for sizes like the text, is measured in x
+        NH, NW = self.getImageSize()
+        self.svgSize = (round(H * outputScale), round(W * outputScale))
+        self.outputScale = outputScale * W / NW
+
+        print(
+            f"Working at {NW}x{NH} ({scale:.2f} scale) instead of {W}x{H}, {1 - NH * NW / (H * W):.0%} fewer pixels "
+            f"in every stage, SVG geometry scaled by {self.outputScale:.2f}"
+        )
+
+        return scale
+
+    def scaleContour(self, contour: np.ndarray) -> list:
+        """
+        Scales a contour from the working resolution to the output size of the SVG
+
+        Arguments:
+            contour: A (N, 1, 2) numpy array of (x, y) points as returned by cv2.findContours
+
+        Returns:
+            points: A list of [x, y] points
+        """
+
+        points = contour.reshape(-1, 2)
+        scaleX, scaleY = self.getOutputScales()
+        if scaleX == 1 and scaleY == 1:
+            return points.tolist()
+
+        return np.round(points * (scaleX, scaleY), 2).tolist()
+
+    def getOutputSize(self) -> "tuple[int, int]":
+        """
+        Gets the (H, W) size of the SVG. After planResolution() this is the output size planned from the full resolution image,
+        otherwise it is the working size scaled by self.outputScale
+
+        Returns:
+            (H, W)
+        """
+
+        if self.svgSize is not None:
+            return self.svgSize
+
+        h, w = self.getImageSize()
+        return round(h * self.outputScale), round(w * self.outputScale)
+
+    def getOutputScales(self) -> "tuple[float, float]":
+        """
+        Gets the scales from the working resolution to the SVG coordinates. x and y are scaled separately since the working
+        size is rounded on each axis on its own
+
+        Returns:
+            (scaleX, scaleY)
+        """
+
+        H, W = self.getOutputSize()
+        h, w = self.getImageSize()
+        return W / w, H / h
+
+    def blurImage_(
+        self,
+        blurType: str,
+        ksize: int = 13,
+        sigma: float = 3,
+        sigmaColor: float = 21,
+        sigmaSpace: float = 21,
+        downsample: int = 4,
+    ) -> None:
+        """
+        Blurs the current image in place according to the arguments of the function.
+        Updates self.image and self.img1d
+
+        The edge preserving blur types trade quality for speed differently:
+            bilateral: The reference quality, but the cost grows with ksize squared. A 21 pixel kernel takes around 20
+                seconds on a 12 MP image
+            guided: A guided filter using the image as its own guide, built from box filters so the cost doesn't depend on
+                ksize. Several times faster than bilateral at large kernels. Edges are kept, but strong edges can get a
+                faint halo and it smooths less inside textured regions than bilateral
+            domain: A recursive domain transform filter which runs 3 iterations of 1D recursive filters along rows and
+                columns. The cost doesn't depend on sigmaSpace and it gives the closest result to bilateral, but it is
+                slower than guided since the recursion steps through the columns and rows one at a time
+            fastbilateral: Runs bilateral on a copy downscaled by the downsample factor and transfers the result back to
+                full resolution with a guided filter fit at the low resolution. Usually the fastest option, around 20
+                times faster than bilateral at the default factor with a similar look, though details smaller than the
+                downsample factor are smoothed less
+
+        Arguments:
+            blurType: 'gaussian', 'median', 'bilateral', 'guided', 'domain' or 'fastbilateral'. Determines the kind of filter to be applied
+            ksize: The size of the blurring kernel to be applied
+            sigma: A sigma for the gaussian kernel type
+            sigmaColor: How large of a range colors should be blended, higher values means more distant colors will be blended
+            sigmaSpace: How intensely pixels in the kernel are blurred
+            downsample: The factor the image is downscaled by for the 'fastbilateral' blur type
+        """
+
+        image = self.image.astype(np.uint8, copy=False)
+        blurred = None
+
+        if blurType == "gaussian":
+            kernel = cv2.getGaussianKernel(ksize=ksize, sigma=sigma)
+            blurred = cv2.sepFilter2D(image, ddepth=-1, kernelX=kernel, kernelY=kernel)
+        elif blurType == "median":
+            blurred = cv2.medianBlur(image, ksize=ksize)
+        elif blurType == "bilateral":
+            blurred = cv2.bilateralFilter(
+                image, d=ksize, sigmaColor=sigmaColor, sigmaSpace=sigmaSpace
+            )
+        elif blurType == "guided":
+            guide = image.astype(np.float32)
+            a, b = self.getGuidedCoefficients(guide, guide, ksize // 2, sigmaColor**2)
+            blurred = self.toUint8(a * guide + b)
+        elif blurType == "domain":
+            blurred = self.toUint8(
+                self.domainTransformFilter(
+                    image.astype(np.float32), sigmaSpace, sigmaColor
+                )
+            )
+        elif blurType == "fastbilateral":
+            H, W = image.shape[:2]
+            small = cv2.resize(
+                image,
+                (max(W // downsample, 1), max(H // downsample, 1)),
+                interpolation=cv2.INTER_AREA,
+            )
+            smallBlurred = cv2.bilateralFilter(
+                small,
+                d=max(ksize // downsample, 3),
+                sigmaColor=sigmaColor,
+                sigmaSpace=sigmaSpace / downsample,
+            )
+
+            # Fit the low resolution blur as a local linear function of the low resolution image, then apply the upscaled
+            # coefficients to the full resolution image so edges stay sharp
+            a, b = self.getGuidedCoefficients(
+                small.astype(np.float32),
+                smallBlurred.astype(np.float32),
+                1,
+                (sigmaColor / 4) ** 2,
+            )
+            a = cv2.resize(a, (W, H), interpolation=cv2.INTER_LINEAR)
+            b = cv2.resize(b, (W, H), interpolation=cv2.INTER_LINEAR)
+            blurred = self.toUint8(a * image + b)
+        else:
+            assert False, f"Unknown blurType {blurType}"
+
+        self.image = blurred
+
+    def toUint8(self, image: np.ndarray) -> np.ndarray:
+        """
+        Rounds and clips a float image to uint8
+
+        Arguments:
+            image: A float numpy array
+
+        Returns:
+            The image as a uint8 numpy array
+        """
+
+        return np.clip(np.rint(image), 0, 255).astype(np.uint8)
+
+    def getGuidedCoefficients(
+        self, guide: np.ndarray, src: np.ndarray, radius: int, eps: float
+    ) -> "tuple[np.ndarray, np.ndarray]":
+        """
+        Fits src as a local linear function a * guide + b of the guide in every (2 * radius + 1) square window, per channel, as in
+        the guided filter. The coefficients are averaged over the windows each pixel is in, so a * guide + b is the filtered image.
+        Only box filters are used, so the cost doesn't depend on the radius.
+
+        Arguments:
+            guide: A (H, W, C) float32 numpy array
+            src: A (H, W, C) float32 numpy array to filter
+            radius: The window radius in pixels
+            eps: The regularization, larger values smooth across larger differences in the guide. In squared intensity units
+
+        Returns:
+            (a, b)
+
+            a: A (H, W, C) float32 numpy array of averaged slopes
+            b: A (H, W, C) float32 numpy array of averaged offsets
+        """
+
+        size = (2 * radius + 1, 2 * radius + 1)
+        meanGuide = cv2.boxFilter(guide, -1, size)
+        meanSrc = cv2.boxFilter(src, -1, size)
+        covariance = cv2.boxFilter(guide * src, -1, size) - meanGuide * meanSrc
+        variance = cv2.boxFilter(guide * guide, -1, size) - meanGuide * meanGuide
+
+        a = covariance / (variance + eps)
+        b = meanSrc - a * meanGuide
+
+        return cv2.boxFilter(a, -1, size), cv2.boxFilter(b, -1, size)
+
+    def domainTransformFilter(
+        self,
+        image: np.ndarray,
+        sigmaSpace: float,
+        sigmaColor: float,
+        iterations: int = 3,
+    ) -> np.ndarray:
+        """
+        An edge preserving filter using the recursive filter version of the domain transform (Gastal and Oliveira, 2011). Every
+        iteration runs a 1D recursive filter forwards and backwards along the rows and then along the columns, where the feedback
+        between neighbouring pixels falls off with their color difference. The cost per pixel is constant for any sigmaSpace.
+
+        Arguments:
+            image: A (H, W, C) float32 numpy array
+            sigmaSpace: The spatial standard deviation of the filter in pixels
+            sigmaColor: The range standard deviation of the filter in intensity units
+            iterations: The number of row and column passes
+
+        Returns:
+            filtered: The filtered (H, W, C) float32 numpy array
+        """
+
+        # The distance between neighbouring pixels in the transformed domain grows with their color difference
+        dx = 1 + sigmaSpace / sigmaColor * np.sum(
+            np.abs(np.diff(image, axis=1)), axis=2
+        )
+        dy = 1 + sigmaSpace / sigmaColor * np.sum(
+            np.abs(np.diff(image, axis=0)), axis=2
+        )
+
+        # Work on the columns of the transposed image for the row pass so each step reads contiguous memory
+        rows = np.ascontiguousarray(image.transpose(1, 0, 2))
+        dx = np.ascontiguousarray(dx.T)
+
+        for i in range(iterations):
+            sigmaI = (
+                sigmaSpace
+                * np.sqrt(3)
+                * 2 ** (iterations - i - 1)
+                / np.sqrt(4**iterations - 1)
+            )
+            feedback = np.exp(-np.sqrt(2) / sigmaI)
+
+            rows = self._recursiveFilter(rows, feedback**dx)
+            columns = np.ascontiguousarray(rows.transpose(1, 0, 2))
+            columns = self._recursiveFilter(columns, feedback**dy)
+            rows = np.ascontiguousarray(columns.transpose(1, 0, 2))
+
+        return rows.transpose(1, 0, 2)
+
+    def _recursiveFilter(self, image: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        """
+        Runs a first order recursive filter along the first axis of image in place, forwards and then backwards
+
+        Arguments:
+            image: A (N, M, C) float32 numpy array
+            weights: A (N - 1, M) numpy array with the feedback weight between each pair of neighbours along the first axis
+
+        Returns:
+            The filtered image
+        """
+
+        weights = weights[..., np.newaxis].astype(np.float32)
+        for n in range(1, image.shape[0]):
+            image[n] += weights[n - 1] * (image[n - 1] - image[n])
+        for n in range(image.shape[0] - 2, -1, -1):
+            image[n] += weights[n] * (image[n + 1] - image[n])
+
+        return image
+
+    def getUniqueColors(self, image=None) -> np.ndarray:
+        """
+        Gets an array of shape (N, 3) which represents all the unique colors present in self.image
+
+        Arguments:
+            image=None: If None, returns the unique colors of self.image, otherwise, performs the operations for the provided image.
+
+        Returns:
+            uniqueColors: A (N, 3) numpy array which represents the found unique colors in the provided or current image.
+        """
+
+        if image is None and self.indexImage is not None:
+            return self.getIndexImage()[1]
+
+        reshaped_image = None
+        if image is None:
+            # Reshape to a 2D array
+            reshaped_image = self.image.reshape(-1, self.image.shape[2])
+        else:
+            reshaped_image = image.reshape(-1, image.shape[2])
+
+        # Find unique color values across the channels
+        uniqueColors = np.unique(reshaped_image, axis=0)
+
+        return uniqueColors
 
-            if showPlots:
-                plt.imshow(labels), plt.title("Pruned clusters")
-                plt.show()
+    def getUniqueColorsMasks(self) -> dict:
+        """
+        Returns a dictionary with indices of each unique color and a binary numpy array representing where each unique color is
+        a key and each value is a binary mask of the image representing where that color is.
+        Every mask is held at once, so prefer iterColorMasks() which only creates one mask at a time.
+
+        Returns:
+            colorsDict: A dictionary with keys of RGB tuples and values of binary masks representing the presence of that key in the image
+        """
+
+        colorsDict = {}
 
-            prunableClusters[tuple(color)] = labels
+        for color, mask, _ in self.iterColorMasks():
+            colorsDict[color] = np.repeat(mask[..., np.newaxis], repeats=3, axis=2)
 
-            if showPlots:
-                binaryLabels = (labels > 0).astype(np.uint8)
-                plt.imshow(mask[..., 0] - binaryLabels), plt.title("After pruning")
-                plt.show()
+        return colorsDict
+
+    def iterColorMasks(self, crop=False):
+        """
+        Yields a 2D mask for each unique color of the image one at a time. The masks are compared on demand against a single
+        index image (see getIndexImage()) and nothing is kept, so memory use doesn't depend on the number of colors.
+
+        Arguments:
+            crop=False: Whether to crop each mask to the bounding box of its color plus a 1 pixel margin, so edge filters
+                give the same result as on the full mask
+
+        Yields:
+            (color, mask, offset)
+
+            color: An (R, G, B) tuple in the same order as getUniqueColors()
+            mask: A (H, W) boolean numpy array, or the cropped part of it
+            offset: The (x, y) position of the mask in the image, (0, 0) unless cropped
+        """
+
+        indexImage, colors = self.getIndexImage()
+        H, W = indexImage.shape
+
+        for idx, color in enumerate(colors):
+            mask = indexImage == idx
+            offset = (0, 0)
+
+            if crop:
+                rows = np.flatnonzero(mask.any(axis=1))
+                cols = np.flatnonzero(mask.any(axis=0))
+                top, bottom = max(rows[0] - 1, 0), min(rows[-1] + 2, H)
+                left, right = max(cols[0] - 1, 0), min(cols[-1] + 2, W)
+                mask = mask[top:bottom, left:right].copy()
+                offset = (left, top)
+
+            yield tuple(color), mask, offset
+
+    def getIndexImage(self, image=None) -> "tuple[np.ndarray, np.ndarray]":
+        """
+        Converts an RGB image to a palette index image where every pixel holds the index of its color
+
+        Arguments:
+            image=None: If None, uses self.image, otherwise, performs the operations for the provided image.
+
+        Returns:
+            (indexImage, colors)
+
+            indexImage: A (H, W) int32 numpy array of color indices, or a uint8/uint16 read-only view of self.indexImage if
+                the current image is already an index image
+            colors: A (N, 3) uint8 numpy array of the unique colors in the same order as getUniqueColors()
+        """
+
+        if image is None and self.indexImage is not None:
+            # Colors that were pruned away are dropped so only colors present in the image are returned. np.unique works at the
+            # index image's dtype where np.bincount would make an int64 copy of it
+            used = np.unique(self.indexImage)
+            if used.shape[0] == self.indexColors.shape[0]:
+                return self.readOnly(self.indexImage), self.indexColors
+
+            remap = np.zeros(self.indexColors.shape[0], dtype=self.indexImage.dtype)
+            remap[used] = np.arange(used.shape[0])
+            return remap[self.indexImage], self.indexColors[used]
+
+        if image is None:
+            image = self.image
+        image = image.astype(np.int32)
+
+        # Packing the channels into one integer sorts the same way as np.unique(axis=0) but is much faster
+        packed = (image[..., 0] << 16) | (image[..., 1] << 8) | image[..., 2]
+        uniquePacked, indexImage = np.unique(packed, return_inverse=True)
+
+        colors = np.stack(
+            [uniquePacked >> 16, (uniquePacked >> 8) & 255, uniquePacked & 255], axis=1
+        ).astype(np.uint8)
+        return indexImage.reshape(packed.shape).astype(np.int32), colors
+
+    def labelRegions(
+        self, indexImage: np.ndarray
+    ) -> "tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]":
+        """
+        Labels the 8-connected regions of every color of a palette index image in a single pass instead of running connected
+        components once per color. Each row is split into runs of the same color, runs that touch a run of the same color in the
+        next row are linked, and the linked runs are grouped with a sparse connected components search. The work scales with the
+        number of runs rather than colors times image area.
+
+        Arguments:
+            indexImage: A (H, W) integer numpy array of color indices, see getIndexImage()
+
+        Returns:
+            (regionMap, regionColors, areas, bboxes, centroids)
+
+            regionMap: A (H, W) int32 numpy array with the region id of every pixel. Region ids start at 0
+            regionColors: A (M,) numpy array with the color index of each region
+            areas: A (M,) numpy array with the number of pixels in each region
+            bboxes: A (M, 4) numpy array with the (x, y, width, height) of each region like cv2.CC_STAT_LEFT to cv2.CC_STAT_HEIGHT
+            centroids: A (M, 2) float numpy array with the (x, y) centroid of each region
+        """
+
+        H, W = indexImage.shape
+        flat = indexImage.reshape(-1)
+
+        # A run starts wherever the color changes or a new row begins
+        runStart = np.empty(flat.shape[0], dtype=bool)
+        runStart[0] = True
+        runStart[1:] = flat[1:] != flat[:-1]
+        runStart[::W] = True
+        starts = np.flatnonzero(runStart)
+        lengths = np.diff(np.append(starts, flat.shape[0]))
+
+        rows = starts // W
+        x0 = starts - rows * W
+        x1 = x0 + lengths - 1
+        runColors = flat[starts]
+        numRuns = starts.shape[0]
+
+        # Keys that sort runs by row and then by position, with a gap between rows so searches don't spill into the next row
+        stride = W + 2
+        startKeys = rows * stride + x0
+        endKeys = rows * stride + x1
+
+        # For 8-connectivity a run touches the runs of the next row that overlap it when widened by one pixel on each side
+        above = np.flatnonzero(rows < H - 1)
+        nextRow = (rows[above] + 1) * stride
+        first = np.searchsorted(endKeys, nextRow + x0[above] - 1, side="left")
+        last = np.searchsorted(startKeys, nextRow + x1[above] + 1, side="right")
+        counts = np.maximum(last - first, 0)
+
+        src = np.repeat(above, counts)
+        dst = np.repeat(first, counts) + (
+            np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        )
+        sameColor = runColors[src] == runColors[dst]
+        src, dst = src[sameColor], dst[sameColor]
+
+        graph = coo_matrix(
+            (np.ones(src.shape[0], dtype=np.int8), (src, dst)), shape=(numRuns, numRuns)
+        )
+        numRegions, runLabels = connected_components(graph, directed=False)
+        runLabels = runLabels.astype(np.int32)
+
+        regionMap = np.repeat(runLabels, lengths).reshape((H, W))
+
+        areas = np.bincount(runLabels, weights=lengths, minlength=numRegions).astype(
+            np.int64
+        )
+        regionColors = np.empty(numRegions, dtype=indexImage.dtype)
+        regionColors[runLabels] = runColors
+
+        # Reduce the run extents per region by sorting the runs by region
+        order = np.argsort(runLabels, kind="stable")
+        regionStarts = np.searchsorted(runLabels[order], np.arange(numRegions))
+        left = np.minimum.reduceat(x0[order], regionStarts)
+        right = np.maximum.reduceat(x1[order], regionStarts)
+        top = np.minimum.reduceat(rows[order], regionStarts)
+        bottom = np.maximum.reduceat(rows[order], regionStarts)
+        bboxes = np.stack([left, top, right - left + 1, bottom - top + 1], axis=1)
+
+        centroids = (
+            np.stack(
+                [
+                    np.bincount(
+                        runLabels, weights=lengths * (x0 + x1) / 2, minlength=numRegions
+                    ),
+                    np.bincount(
+                        runLabels, weights=lengths * rows, minlength=numRegions
+                    ),
+                ],
+                axis=1,
+            )
+            / areas[:, np.newaxis]
+        )
+
+        return regionMap, regionColors, areas, bboxes, centroids
+
+    def generatePrunableClusters(self, showPlots=False, window=None) -> bool:
+        """
+        Stores the clusters which can be pruned from the main image in self.prunableClusters. The small pruned clusters can be replaced by the nearest color
+        in the original image in a different function. The treshold used to determine which clusters should be removed is defined as self.pruningThreshold
+
+        Every cluster is a dict with its 'color' as an (R, G, B) tuple, its 'area', its (x, y, width, height) 'bbox' and the flat
+        image indices of its 'pixels'. Only the prunable pixels are stored, so memory scales with the size of the pruned clusters
+        rather than the number of colors times the image area. The clusters are ordered by color and then by position.
+
+        Arguments:
+            showPlots=False: Whether or not to show plots of pruned clusters
+            window=None: An optional (top, bottom, left, right) window of the image to search. Clusters cut by the window edge are
+                left out since their full area is unknown
+
+        Returns:
+            Whether every small cluster in the window was found. This is False when a small cluster is cut by the window edge,
+            in which case the window is too small and the whole image should be searched instead
+        """
+
+        H, W = self.getImageSize()
+        top, bottom, left, right = window if window is not None else (0, H, 0, W)
+
+        if self.indexImage is not None:
+            indexImage = self.indexImage[top:bottom, left:right]
+            colors = self.indexColors
+        else:
+            indexImage, colors = self.getIndexImage(self.image[top:bottom, left:right])
+        regionMap, regionColors, areas, bboxes, centroids = self.labelRegions(
+            indexImage
+        )
+
+        if showPlots:
+            plt.imshow(regionMap), plt.title("Before pruning")
+            plt.show()
+
+        imageArea = self.getImageArea()
+        # Get an array representing the clusters that are too small and should be pruned
+        tooSmall = imageArea * self.pruningThreshold > areas
+
+        # Clusters touching a window edge which isn't also an image edge may continue outside of the window
+        x, y, w, h = bboxes.T
+        cut = (
+            ((x == 0) & (left > 0))
+            | ((y == 0) & (top > 0))
+            | ((x + w == right - left) & (right < W))
+            | ((y + h == bottom - top) & (bottom < H))
+        )
+        complete = not np.any(tooSmall & cut)
+        tooSmall &= ~cut
+
+        # Group the pixels of the prunable clusters by cluster and convert their window positions to image positions
+        flatMap = regionMap.reshape(-1)
+        pixels = np.flatnonzero(tooSmall[flatMap])
+        pixels = pixels[np.argsort(flatMap[pixels], kind="stable")]
+        pixels = (pixels // (right - left) + top) * W + pixels % (right - left) + left
+
+        prunableIds = np.flatnonzero(tooSmall)
+        clusterPixels = np.split(pixels, np.cumsum(areas[prunableIds])[:-1])
+
+        if showPlots:
+            plt.imshow(tooSmall[regionMap]), plt.title("Pruned clusters")
+            plt.show()
+
+        colorTuples = [tuple(color) for color in colors]
+        clusterColors = regionColors[prunableIds].tolist()
+        clusterAreas = areas[prunableIds].tolist()
+        clusterBoxes = bboxes[prunableIds] + np.array([left, top, 0, 0])
+
+        prunableClusters = []
+        for idx in np.lexsort((prunableIds, clusterColors)).tolist():
+            prunableClusters.append(
+                {
+                    "color": colorTuples[clusterColors[idx]],
+                    "area": clusterAreas[idx],
+                    "bbox": clusterBoxes[idx],
+                    "pixels": clusterPixels[idx],
+                }
+            )
 
         self.prunableClusters = prunableClusters
 
+        return complete
+
+    def getDirtyWindows(
+        self, dirtyBoxes: "list[np.ndarray]", tileSize=32
+    ) -> "list[tuple[int, int, int, int]]":
+        """
+        Groups the bounding boxes of changed pixels into non-overlapping windows of the image that need to be searched again.
+        The image is divided into tiles, every tile overlapping a box and its neighbouring tiles are marked, and each group of
+        connected tiles becomes one window. Windows whose bounding rectangles overlap are merged.
+
+        Arguments:
+            dirtyBoxes: A list of (N, 4) numpy arrays with the (x, y, width, height) boxes of the changed pixels
+            tileSize=32: The side length of a tile in pixels
+
+        Returns:
+            A list of (top, bottom, left, right) windows in pixels
+        """
+
+        H, W = self.getImageSize()
+        tiles = np.zeros((-(-H // tileSize), -(-W // tileSize)), dtype=np.uint8)
+
+        for x, y, w, h in np.concatenate(dirtyBoxes):
+            tiles[
+                y // tileSize : (y + h - 1) // tileSize + 1,
+                x // tileSize : (x + w - 1) // tileSize + 1,
+            ] = 1
+
+        # The neighbouring tiles give every changed pixel at least a tile of context in each direction
+        tiles = cv2.dilate(tiles, np.ones((3, 3), dtype=np.uint8))
+        _, _, stats, _ = cv2.connectedComponentsWithStats(tiles, connectivity=8)
+        windows = [[y, y + h, x, x + w] for x, y, w, h, _ in stats[1:]]
+
+        merged = True
+        while merged:
+            merged = False
+            for i in range(len(windows)):
+                for j in range(len(windows) - 1, i, -1):
+                    a, b = windows[i], windows[j]
+                    if a[0] < b[1] and b[0] < a[1] and a[2] < b[3] and b[2] < a[3]:
+                        windows[i] = [
+                            min(a[0], b[0]),
+                            max(a[1], b[1]),
+                            min(a[2], b[2]),
+                            max(a[3], b[3]),
+                        ]
+                        del windows[j]
+                        merged = True
+
+        return [
+            (
+                top * tileSize,
+                min(bottom * tileSize, H),
+                left * tileSize,
+                min(right * tileSize, W),
+            )
+            for top, bottom, left, right in windows
+        ]
+
     def getClusteringEffectiveness(
         self,
     ) -> "tuple[dict, dict, dict, dict, int, int, float]":
@@ -468,351 +2063,1158 @@ class PbnGen:
             Dictionaries with the number of clusters per color in the current image, and how many will be pruned
         """
 
-        colorsDict = self.getUniqueColorsMasks()
+        indexImage, colors = self.getIndexImage()
+        _, regionColors, areas, _, _ = self.labelRegions(indexImage)
 
-        rawCounts = {}
-        prunedCounts = {}
+        imageArea = self.getImageArea()
+        # Get an array representing the clusters that are too small and should be pruned
+        tooSmall = imageArea * self.pruningThreshold > areas
 
-        for color in colorsDict.keys():
-            mask = colorsDict[color]
+        rawCounts = np.bincount(regionColors, minlength=colors.shape[0])
+        prunedCounts = np.bincount(regionColors[tooSmall], minlength=colors.shape[0])
 
-            # The mask seems to need to be a "binary" image but the binary values are 0 and 255 instead of 0 and 1
-            (
-                numLabels,
-                labels,
-                stats,
-                centroids,
-            ) = cv2.connectedComponentsWithStatsWithAlgorithm(
-                (mask[..., 0] * 255).astype(np.uint8), 8, cv2.CV_32S, cv2.CCL_WU
+        colorKeys = [tuple(color) for color in colors]
+        return dict(zip(colorKeys, rawCounts)), dict(zip(colorKeys, prunedCounts))
+
+    def getMainSurroundingColor(self, image, mask) -> np.ndarray:
+        """
+        Returns the main surrounding color given a binary mask and image. The function will check the edges of the mask to determine the present colors
+        and will return the most common color surrounding the mask.
+
+        Arguments:
+            image: The image to use as a reference for the surrounding colors
+            mask: A binary mask which will be used to determine the cluster of pixels we want to find the common color around
+
+        Returns:
+            mostCommonColor: A (3,) numpy array which holds the RGB value of the most common color, or the most common index
+                if image is a (H, W) index image
+        """
+
+        assert image.shape[:2] == mask.shape, "Image and mask shapes are different!"
+
+        edgeFilter = np.array(([0, 1, 0], [1, -4, 1], [0, 1, 0]))
+
+        maskEdges = cv2.filter2D(mask, ddepth=-1, kernel=edgeFilter)
+
+        # plt.figure(figsize=(20, 20)), plt.imshow(maskEdges), plt.title('Small cluster edge'), plt.show()
+
+        surroundingColors = image[maskEdges.astype(bool)]
+
+        if image.ndim == 2:
+            mostCommonIndex = Counter(surroundingColors.tolist()).most_common(1)[0][0]
+            return np.array(mostCommonIndex, dtype=image.dtype)
+
+        # most_common(1) returns a list with a single tuple (key, count)
+        mostCommonColor = Counter(map(tuple, surroundingColors)).most_common(1)[0][0]
+        return np.array(mostCommonColor, dtype=np.uint8)
+
+    def getMainSurroundingColorVectorized(
+        self, image, mask, uniqueLabels
+    ) -> np.ndarray:
+        """
+        Returns the main surrounding colors given a labeled mask and image. The function will check the edges of the mask to determine the present colors
+        and will return the most common color surrounding the mask.
+        The edges of all labels are found at once by comparing the mask with copies of itself shifted by one pixel in each of the
+        4 directions, and the most common color per label is found with a single np.bincount over packed (label, color) keys, so
+        the cost doesn't depend on how many labels there are.
+
+        Arguments:
+            image: The (H, W, 3) RGB image or (H, W) index image to use as a reference for the surrounding colors
+            mask: A (H, W) labeled mask where each cluster has its own positive label and the background is 0
+            uniqueLabels: A sorted (N,) numpy array of the labels to get the surrounding colors of
+
+        Returns:
+            modeColors: A (N, 3) numpy array which holds the RGB values of the most common colors for each label, or a (N,)
+                numpy array of the most common indices if image is an index image
+        """
+
+        H, W = mask.shape
+        flatMask = mask.reshape(-1)
+        pixelIds = np.arange(H * W).reshape((H, W))
+
+        # An edge pixel is any pixel outside a label that is directly above, below, left or right of it
+        labelPixels = []
+        edgePixels = []
+        for inside, outside in (
+            (np.s_[:, 1:], np.s_[:, :-1]),
+            (np.s_[:, :-1], np.s_[:, 1:]),
+            (np.s_[1:, :], np.s_[:-1, :]),
+            (np.s_[:-1, :], np.s_[1:, :]),
+        ):
+            isEdge = (mask[inside] != mask[outside]) & (mask[inside] != 0)
+            labelPixels.append(pixelIds[inside][isEdge])
+            edgePixels.append(pixelIds[outside][isEdge])
+
+        labelPixels = np.concatenate(labelPixels)
+        edgePixels = np.concatenate(edgePixels)
+
+        # Only consider the requested labels
+        labelIdx = np.searchsorted(uniqueLabels, flatMask[labelPixels])
+        labelIdx = np.minimum(labelIdx, uniqueLabels.shape[0] - 1)
+        requested = uniqueLabels[labelIdx] == flatMask[labelPixels]
+        labelIdx, edgePixels = labelIdx[requested], edgePixels[requested]
+
+        # An edge pixel touching a label on several sides still only counts once for it
+        pairs = np.unique(labelIdx.astype(np.int64) * (H * W) + edgePixels)
+        labelIdx, edgePixels = pairs // (H * W), pairs % (H * W)
+
+        if image.ndim == 2:
+            packed = image.reshape(-1)[edgePixels].astype(np.int64)
+        else:
+            edgeColors = image.reshape((-1, 3))[edgePixels].astype(np.int64)
+            packed = (
+                (edgeColors[:, 0] << 16) | (edgeColors[:, 1] << 8) | edgeColors[:, 2]
+            )
+        colors, colorIdx = np.unique(packed, return_inverse=True)
+        colorIdx = colorIdx.reshape(-1)
+
+        votes = np.bincount(
+            labelIdx * colors.shape[0] + colorIdx,
+            minlength=uniqueLabels.shape[0] * colors.shape[0],
+        ).reshape((uniqueLabels.shape[0], colors.shape[0]))
+        modePacked = colors[np.argmax(votes, axis=1)]
+
+        if image.ndim == 2:
+            return modePacked.astype(image.dtype)
+
+        modeColors = np.stack(
+            [modePacked >> 16, (modePacked >> 8) & 255, modePacked & 255], axis=1
+        )
+        return modeColors.astype(np.uint8)
+
+    def pruneComponentsLocal(
+        self, image: np.ndarray, clusters: list, sparseFraction: float = 1 / 16
+    ):
+        """
+        Replaces each cluster in place with its main surrounding color. All clusters vote in a single
+        getMainSurroundingColorVectorized() pass over the smallest window holding them, so the cost doesn't grow with the number
+        of clusters. Every cluster sees the colors around it as they were before any cluster was replaced.
+
+        When the clusters are sparse, each cluster is instead cropped to its bounding box plus a 1 pixel margin for the edge
+        pixels, so the work per cluster is proportional to its size rather than the window size.
+
+        Arguments:
+            image: The (H, W, 3) RGB image or (H, W) index image to edit in place
+            clusters: A list of clusters in the format of self.prunableClusters, see generatePrunableClusters()
+            sparseFraction: The clusters are pruned one by one when their padded bounding boxes cover less than this fraction
+                of the window holding them
+        """
+
+        if len(clusters) == 0:
+            return
+
+        H, W = image.shape[:2]
+        x, y, w, h = np.array([cluster["bbox"] for cluster in clusters]).T
+        top, bottom = max(y.min() - 1, 0), min((y + h).max() + 1, H)
+        left, right = max(x.min() - 1, 0), min((x + w).max() + 1, W)
+
+        if np.sum((w + 2) * (h + 2)) >= sparseFraction * (bottom - top) * (
+            right - left
+        ):
+            # Every cluster gets its own label, numbered from 1 so 0 is left for the pixels that aren't pruned
+            areas = [cluster["area"] for cluster in clusters]
+            labels = np.repeat(np.arange(1, len(clusters) + 1, dtype=np.int32), areas)
+            ys, xs = np.divmod(
+                np.concatenate([cluster["pixels"] for cluster in clusters]), W
+            )
+            maskCrop = np.zeros((bottom - top, right - left), dtype=np.int32)
+            maskCrop[ys - top, xs - left] = labels
+
+            surroundingColors = self.getMainSurroundingColorVectorized(
+                image[top:bottom, left:right],
+                maskCrop,
+                np.arange(1, len(clusters) + 1),
+            )
+            image[ys, xs] = surroundingColors[labels - 1]
+            return
+
+        for cluster in clusters:
+            x, y, w, h = cluster["bbox"]
+            top, bottom = max(y - 1, 0), min(y + h + 1, H)
+            left, right = max(x - 1, 0), min(x + w + 1, W)
+
+            ys, xs = np.divmod(cluster["pixels"], W)
+            maskCrop = np.zeros((bottom - top, right - left), dtype=np.uint8)
+            maskCrop[ys - top, xs - left] = 1
+
+            surroundingColor = self.getMainSurroundingColorVectorized(
+                image[top:bottom, left:right], maskCrop, np.array([1])
+            )[0]
+            image[ys, xs] = surroundingColor
+
+    # TODO: If time allows, re-write this to merge similar intensities along strong gradients to preserve things like the whiskers in the Red Panda image
+    def pruneClustersSmart(
+        self,
+        iterations: int = 3,
+        pruneBySize=False,
+        reversePruneBySize=False,
+        reversePruneByIntensity=True,
+        showPlots=False,
+    ):
+        """
+        Prunes small color clusters in order of cluster size and color intensity. The pruned clusters are based on the self.pruningThreshold class variable
+        and this function just determines the order that clusters are pruned to produce slightly different results.
+
+        Arguments:
+            iterations: How many times clusters are pruned by repeating this same function.
+            pruneBySize=False: Whether prunable clusters should be pruned from smallest to largest.
+            reversePruneBySize=False: By default, prunes clusters from smallest to largest. Set to True to prune by largest to smallest.
+            reversePruneByIntensity=True: Whether clusters should be pruned based on color intensity in order from darkest to lightest by default.
+            showPlots=False: Whether to show intermediate pruning plots for each iteration.
+        """
+
+        self.toIndexImage_()
+
+        for i in range(iterations):
+            self.generatePrunableClusters(showPlots=False)
+
+            image = self.indexImage
+
+            # Group the clusters by color, keeping their order
+            prunableClusters = {}
+            for cluster in self.prunableClusters:
+                prunableClusters.setdefault(cluster["color"], []).append(cluster)
+
+            if showPlots:
+                # Clusters are pruned in place, so keep a copy to compare against
+                before = image.copy()
+                plt.figure(figsize=(20, 20)), plt.imshow(
+                    self.indexColors[before]
+                ), plt.title("Before pruning"), plt.show()
+
+            colorsOrdered = sorted(
+                prunableClusters.items(),
+                key=lambda x: np.sum(np.array(x[0])) ** 2,
+                reverse=reversePruneByIntensity,
+            )
+
+            for color, clusters in colorsOrdered:
+                # Get the clusters in an order sorted by their patch size
+                if pruneBySize:
+                    order = np.argsort(
+                        [cluster["area"] for cluster in clusters], kind="stable"
+                    )
+                    if reversePruneBySize:
+                        order = order[::-1]
+                    clusters = [clusters[idx] for idx in order]
+
+                self.pruneComponentsLocal(image, clusters)
+
+            if showPlots:
+                plt.figure(figsize=(20, 20)), plt.imshow(
+                    self.indexColors[image]
+                ), plt.title("After pruning"), plt.show()
+
+                plt.figure(figsize=(20, 20)), plt.imshow(before != image), plt.title(
+                    "Diff"
+                ), plt.show()
+
+            self.setIndexImage(image, self.indexColors)
+
+    def pruneClustersSimple(
+        self,
+        iterations: int = None,
+        showPlots=False,
+        trySlow=False,
+        maxIterations: int = 50,
+    ):
+        """
+        A simple cluster pruning method which iteratively prunes the smallest clusters below the self.pruningThreshold class variable.
+        In most cases, this simple method produces similar results to pruneClustersSmart(), but is faster.
+
+        Only the first iteration searches the whole image. Pruning a cluster can only leave a small cluster behind where pixels
+        changed, so the later iterations only search windows around the pruned clusters, see getDirtyWindows(). Pruning stops
+        once no cluster is below the threshold. The number of clusters pruned in each iteration is stored in self.pruningHistory
+
+        Arguments:
+            iterations: The maximum number of pruning iterations. If None, clusters are pruned until none are left below the threshold
+            maxIterations: A safety cap when iterations is None. Small clusters which only touch each other can keep swapping
+                colors without converging, so pruning stops with a warning after this many iterations
+        """
+
+        if self.verbose:
+            print("Starting pruning... \nIteration: ", end="")
+
+        if trySlow:
+            print(
+                "WARNING: USING ITERATIVE self.getMainSurroundingColor()! EXPECT POOR PERFORMANCE"
+            )
+
+        # Pruning only ever compares and copies palette indices
+        self.toIndexImage_()
+
+        H, W = self.getImageSize()
+        fullImage = [(0, H, 0, W)]
+        windows = fullImage
+        self.pruningHistory = []
+
+        warnAtLimit = iterations is None
+        if warnAtLimit:
+            iterations = maxIterations
+
+        while len(self.pruningHistory) < iterations:
+            # Windows don't overlap, so pruning one in place doesn't change the clusters found in the others
+            image = self.indexImage
+            # Keep a copy to compare against in the plots
+            before = image.copy() if showPlots else None
+
+            dirtyBoxes = []
+            complete = True
+            for top, bottom, left, right in windows:
+                # print('Starting generatePrunableClusters()')
+                complete &= self.generatePrunableClusters(
+                    showPlots=False, window=(top, bottom, left, right)
+                )
+                # print('Done!')
+
+                prunableClusters = self.prunableClusters
+
+                # print('Starting pruning loop')
+                if trySlow:
+                    # A much slower iterative version of cluster pruning
+                    for cluster in prunableClusters:
+                        ys, xs = np.divmod(cluster["pixels"], W)
+                        clusterMask = np.zeros((H, W), dtype=np.uint8)
+                        clusterMask[ys, xs] = 1
+                        image[ys, xs] = self.getMainSurroundingColor(image, clusterMask)
+
+                else:
+                    # The fast version which only works inside each cluster's bounding box
+                    self.pruneComponentsLocal(image, prunableClusters)
+
+                dirtyBoxes.append(
+                    np.array([cluster["bbox"] for cluster in prunableClusters]).reshape(
+                        (-1, 4)
+                    )
+                )
+
+            numPruned = sum(len(bboxes) for bboxes in dirtyBoxes)
+            if numPruned == 0 and complete:
+                break
+
+            if self.verbose:
+                print(f"{len(self.pruningHistory) + 1} ({numPruned}) ", end="")
+            self.pruningHistory.append(numPruned)
+
+            if showPlots:
+                plt.figure(figsize=(20, 20)), plt.imshow(
+                    self.indexColors[before]
+                ), plt.title("Before pruning"), plt.show()
+                plt.figure(figsize=(20, 20)), plt.imshow(
+                    self.indexColors[image]
+                ), plt.title("After pruning"), plt.show()
+
+                plt.figure(figsize=(20, 20)), plt.imshow(before != image), plt.title(
+                    "Diff"
+                ), plt.show()
+
+            self.setIndexImage(image, self.indexColors)
+            # A small cluster cut by a window edge may reach far outside of it, so the next iteration searches the whole image
+            windows = self.getDirtyWindows(dirtyBoxes) if complete else fullImage
+        else:
+            if warnAtLimit:
+                warning = f"WARNING: Pruning didn't converge after {maxIterations} iterations, small clusters may remain"
+                if self.verbose:
+                    print(f"\n{warning}", end="")
+                else:
+                    print(warning)
+
+        if self.verbose:
+            print(f"\nDone after {len(self.pruningHistory)} iterations!")
+
+    def getRegionAdjacency(
+        self, regionMap: np.ndarray
+    ) -> "tuple[np.ndarray, np.ndarray, np.ndarray]":
+        """
+        Finds which regions of a region map touch and how long their shared boundary is. The boundary length counts the
+        horizontally and vertically adjacent pixel pairs. Regions that only touch diagonally are included with a length of 0
+        since they are still 8-connected.
+
+        Arguments:
+            regionMap: A (H, W) integer numpy array of region ids, see labelRegions()
+
+        Returns:
+            (first, second, lengths)
+
+            first: A (E,) numpy array with the smaller region id of each adjacent pair
+            second: A (E,) numpy array with the larger region id of each adjacent pair
+            lengths: A (E,) numpy array with the shared boundary length of each pair
+        """
+
+        numRegions = np.int64(regionMap.max()) + 1
+        keys = []
+        weights = []
+        # Right and down neighbours form the boundary, the two diagonals only add connectivity
+        for a, b, weight in (
+            (regionMap[:, :-1], regionMap[:, 1:], 1),
+            (regionMap[:-1, :], regionMap[1:, :], 1),
+            (regionMap[:-1, :-1], regionMap[1:, 1:], 0),
+            (regionMap[:-1, 1:], regionMap[1:, :-1], 0),
+        ):
+            differs = a != b
+            low = np.minimum(a[differs], b[differs]).astype(np.int64)
+            high = np.maximum(a[differs], b[differs]).astype(np.int64)
+            keys.append(low * numRegions + high)
+            weights.append(np.full(low.shape[0], weight))
+
+        keys = np.concatenate(keys)
+        pairs, inverse = np.unique(keys, return_inverse=True)
+        lengths = np.bincount(inverse.reshape(-1), weights=np.concatenate(weights))
+
+        return pairs // numRegions, pairs % numRegions, lengths.astype(np.int64)
+
+    def pruneClustersGraph(self):
+        """
+        Removes every cluster smaller than self.pruningThreshold in a single pass. A region adjacency graph is built once from the
+        labeled image, with every edge holding the shared boundary length. The smallest region is then repeatedly taken from a
+        priority queue and absorbed by the neighbour it shares the longest boundary with. Areas and adjacencies are updated
+        incrementally, and neighbours of the same color that become connected through the merge are joined too. Unlike
+        pruneClustersSimple(), no small cluster can remain afterwards.
+
+        The merged regions are stored in self.regionMap, self.regionColors, self.regionAreas and self.regionNeighbours.
+        """
+
+        indexImage, colors = self.getIndexImage()
+        regionMap, regionColors, areas, _, _ = self.labelRegions(indexImage)
+        first, second, lengths = self.getRegionAdjacency(regionMap)
+
+        numRegions = areas.shape[0]
+        minArea = self.getImageArea() * self.pruningThreshold
+
+        neighbours = [dict() for _ in range(numRegions)]
+        for a, b, length in zip(first.tolist(), second.tolist(), lengths.tolist()):
+            neighbours[a][b] = length
+            neighbours[b][a] = length
+
+        areas = areas.tolist()
+        regionColors = regionColors.tolist()
+        # Every region points to the region it was merged into, or to itself if it is still alive
+        parents = list(range(numRegions))
+
+        def absorb(target, source):
+            parents[source] = target
+            areas[target] += areas[source]
+            for neighbour, length in neighbours[source].items():
+                del neighbours[neighbour][source]
+                if neighbour == target:
+                    continue
+                neighbours[target][neighbour] = (
+                    neighbours[target].get(neighbour, 0) + length
+                )
+                neighbours[neighbour][target] = neighbours[target][neighbour]
+            neighbours[source] = {}
+
+        queue = [(area, region) for region, area in enumerate(areas) if area < minArea]
+        heapq.heapify(queue)
+        merges = 0
+
+        while queue:
+            area, region = heapq.heappop(queue)
+            # Skip entries for regions that were merged away or have grown since they were queued
+            if parents[region] != region or area != areas[region]:
+                continue
+            if not neighbours[region]:
+                continue
+
+            target = max(
+                neighbours[region],
+                key=lambda n: (neighbours[region][n], areas[n]),
+            )
+            formerNeighbours = list(neighbours[region])
+            absorb(target, region)
+            merges += 1
+
+            # Regions of the target's color that only touched it through the absorbed region are now part of it
+            for neighbour in formerNeighbours:
+                if (
+                    neighbour != target
+                    and parents[neighbour] == neighbour
+                    and regionColors[neighbour] == regionColors[target]
+                ):
+                    absorb(target, neighbour)
+
+            if areas[target] < minArea:
+                heapq.heappush(queue, (areas[target], target))
+
+        # Resolve every region to the region it ended up in and give the survivors compact ids
+        parents = np.array(parents)
+        while True:
+            resolved = parents[parents]
+            if np.array_equal(resolved, parents):
+                break
+            parents = resolved
+
+        survivors, compact = np.unique(parents, return_inverse=True)
+        compact = compact.reshape(-1).astype(np.int32)
+
+        self.regionMap = compact[regionMap]
+        survivorColors = np.array(regionColors, dtype=indexImage.dtype)[survivors]
+        self.regionColors = colors[survivorColors]
+        self.regionAreas = np.array(areas)[survivors]
+        self.regionNeighbours = [
+            {int(compact[n]): length for n, length in neighbours[region].items()}
+            for region in survivors
+        ]
+
+        if self.verbose:
+            print(
+                f"Merged {merges} small clusters, {survivors.shape[0]} regions remain"
             )
 
-            rawCounts[color] = numLabels
+        self.setIndexImage(survivorColors[self.regionMap], colors)
+
+    def pruneClustersFill(self):
+        """
+        Removes every cluster smaller than self.pruningThreshold in one operation. The pixels of all small clusters are marked as
+        unknown at once, and every unknown pixel takes the color of the nearest pixel of a surviving cluster, found with a single
+        distance transform. There is no loop over clusters, and neighbouring small clusters can't swap colors back and forth between
+        iterations like they can in pruneClustersSimple(). A small cluster between two large ones is split between them along the
+        line of equal distance instead of going entirely to one of them.
+        """
+
+        self.toIndexImage_()
+
+        regionMap, regionColors, areas, _, _ = self.labelRegions(self.indexImage)
+        tooSmall = self.getImageArea() * self.pruningThreshold > areas
+        unknown = tooSmall[regionMap]
+
+        if unknown.all():
+            print("Every cluster is below the pruning threshold, nothing to fill from")
+            return
+
+        image = self.indexImage
+        self.fillUnknown(image, unknown)
+
+        if self.verbose:
+            print(f"Filled {np.count_nonzero(tooSmall)} small clusters")
 
-            labelIndices = np.arange(1, numLabels)
-            areas = stats[labelIndices, -1]
+        self.setIndexImage(image, self.indexColors)
 
-            imageArea = self.getImageArea()
-            # Get an array representing the clusters that are too small and should be pruned
-            tooSmall = imageArea * self.pruningThreshold > areas
-            tooSmallCount = np.sum(tooSmall.astype(np.uint8))
-            prunedCounts[color] = tooSmallCount
+    def fillUnknown(self, indexImage: np.ndarray, unknown: np.ndarray):
+        """
+        Gives every unknown pixel of an index image, in place, the index of the nearest known pixel with a single distance transform
 
-        return rawCounts, prunedCounts
+        Arguments:
+            indexImage: A (H, W) uint8 or uint16 numpy array of color indices, see setIndexImage()
+            unknown: A (H, W) boolean numpy array of the pixels to fill. At least one pixel must be known
+        """
 
-    def getMainSurroundingColor(self, image, mask) -> np.ndarray:
+        # Every known pixel gets its own label in raster order, and every unknown pixel gets the label of its nearest known pixel
+        _, nearest = cv2.distanceTransformWithLabels(
+            unknown.astype(np.uint8),
+            cv2.DIST_L2,
+            5,
+            labelType=cv2.DIST_LABEL_PIXEL,
+        )
+        knownColors = np.concatenate(
+            [np.zeros(1, dtype=indexImage.dtype), indexImage[~unknown]]
+        )
+        indexImage[unknown] = knownColors[nearest[unknown]]
+
+    def modeFilter(
+        self, indexImage: np.ndarray, ksize: int = 3, passes: int = 1
+    ) -> np.ndarray:
         """
-        Returns the main surrounding color given a binary mask and image. The function will check the edges of the mask to determine the present colors
-        and will return the most common color surrounding the mask.
+        Replaces every pixel of an index image by the most common index in the ksize x ksize window around it, which removes
+        specks and smooths jagged boundaries without any connected component analysis. The window counts of each index come from
+        one unnormalized box filter per index, so a pass costs one box filter per color and only a few (H, W) arrays are alive at
+        once no matter how many colors there are. A pixel keeps its index when another index is only tied with it.
 
         Arguments:
-            image: The image to use as a reference for the surrounding colors
-            mask: A binary mask which will be used to determine the cluster of pixels we want to find the common color around
+            indexImage: A (H, W) uint8 or uint16 numpy array of color indices, see setIndexImage()
+            ksize=3: The odd side length of the window
+            passes=1: How many times the filter is applied
 
         Returns:
-            mostCommonColor: A (3,) numpy array which holds the RGB value of the most common color
+            filtered: The filtered (H, W) index image
         """
 
-        assert image.shape[:-1] == mask.shape, "Image and mask shapes are different!"
+        assert ksize % 2 == 1, f"ksize must be odd, got {ksize}"
+
+        filtered = indexImage
+        for _ in range(passes):
+            bestIndex = filtered.copy()
+            bestCount = np.zeros(filtered.shape, dtype=np.uint16)
+            ownCount = np.zeros(filtered.shape, dtype=np.uint16)
+
+            for idx in np.unique(filtered):
+                isIndex = filtered == idx
+                counts = cv2.boxFilter(
+                    isIndex.astype(np.uint8),
+                    cv2.CV_16U,
+                    (ksize, ksize),
+                    normalize=False,
+                )
 
-        edgeFilter = np.array(([0, 1, 0], [1, -4, 1], [0, 1, 0]))
+                np.copyto(bestIndex, idx, where=counts > bestCount)
+                np.maximum(bestCount, counts, out=bestCount)
+                np.copyto(ownCount, counts, where=isIndex)
 
-        maskEdges = cv2.filter2D(mask, ddepth=-1, kernel=edgeFilter)
+            filtered = np.where(bestCount > ownCount, bestIndex, filtered)
 
-        # plt.figure(figsize=(20, 20)), plt.imshow(maskEdges), plt.title('Small cluster edge'), plt.show()
+        return filtered
 
-        surroundingColors = image[maskEdges.astype(bool)]
+    def modeFilter_(self, ksize: int = 3, passes: int = 1):
+        """
+        Applies modeFilter() to the current image in place, converting it to an index image first if needed
 
-        # most_common(1) returns a list with a single tuple (key, count)
-        mostCommonColor = Counter(map(tuple, surroundingColors)).most_common(1)[0][0]
-        return np.array(mostCommonColor, dtype=np.uint8)
+        Arguments:
+            ksize=3: The odd side length of the window
+            passes=1: How many times the filter is applied
+        """
 
-    def getMainSurroundingColorVectorized(
-        self, image, mask, uniqueLabels
+        self.toIndexImage_()
+        self.setIndexImage(
+            self.modeFilter(self.indexImage, ksize, passes), self.indexColors
+        )
+
+    def getBoundaryImage(
+        self, image: np.ndarray = None, scale: float = 1
     ) -> np.ndarray:
         """
-        Returns the main surrounding colors given a labeled mask and image. The function will check the edges of the mask to determine the present colors
-        and will return the most common color surrounding the mask.
+        Gets a boundary image between colors in a PBN template by running an edge filter on the provided image or self.image.
+        Upscaling the image before passing it to this function gives better resolution.
 
         Arguments:
-            image: The image to use as a reference for the surrounding colors
-            mask: A 3D binary mask of shape (H, W, N) where N is the number of unique clusters excluding the background. The mask should be 1 where
-                a certain unique label exists and 0 elsewhere.
+            image: An input image or 2D mask to get the edges of. Uses self.image if image is None
+            scale: A value to scale the image by before applying the edge filter. Useful if you want higher resolution
+                in the resulting boundary image for labeling regions.
 
         Returns:
-            modeColors: A (N, 3) numpy array which holds the RGB values of the most common colors for each label
+            boundaryImage: A binary image that represents the boundaries found when applying the edge filter.
         """
 
-        # assert image.shape[:-1] == mask.shape, 'Image and mask shapes are different!'
+        img = None
+        if image is None:
+            img = self.getImage().astype(np.uint8, copy=False)
+        else:
+            img = image.astype(np.uint8, copy=False)
 
-        edgeFilter = np.array(([0, 1, 0], [1, -4, 1], [0, 1, 0]), dtype=np.int32)
+        edgeFilter = np.array(([0, 1, 0], [1, -4, 1], [0, 1, 0]))
 
-        modeColors = []
-        for label in uniqueLabels:
-            maskEdges = cv2.filter2D(
-                (mask == label).astype(np.uint8), ddepth=-1, kernel=edgeFilter
-            ).astype(bool)
-            # plt.figure(figsize=(20, 20)), plt.imshow(maskEdges), plt.title('Small cluster edge'), plt.show()
-            modeColors.append(
-                Counter(map(tuple, image[maskEdges])).most_common(1)[0][0]
-            )
+        if scale != 1:
+            img = self.resizeImage(image=img, scale=scale)
 
-        return np.array(modeColors, dtype=np.uint8)
+        boundaryImage = cv2.filter2D(img, ddepth=-1, kernel=edgeFilter)
+        if boundaryImage.ndim == 3:
+            boundaryImage = np.sum(boundaryImage, axis=2)
+        boundaryImage[boundaryImage > 0] = 1
 
-    # TODO: If time allows, re-write this to merge similar intensities along strong gradients to preserve things like the whiskers in the Red Panda image
-    def pruneClustersSmart(
-        self,
-        iterations: int = 3,
-        pruneBySize=False,
-        reversePruneBySize=False,
-        reversePruneByIntensity=True,
-        showPlots=False,
-    ):
+        return boundaryImage
+
+    def blurForScale_(self, scale: float = 1):
         """
-        Prunes small color clusters in order of cluster size and color intensity. The pruned clusters are based on the self.pruningThreshold class variable
-        and this function just determines the order that clusters are pruned to produce slightly different results.
+        The blur set_final_pbn() starts with. It is tuned for the full size image, so the kernel shrinks with the working scale
 
         Arguments:
-            iterations: How many times clusters are pruned by repeating this same function.
-            pruneBySize=False: Whether prunable clusters should be pruned from smallest to largest. This has a large impact on performance if set to True.
-                When set to False, the smart method is pretty much as fast as the simple method
-            reversePruneBySize=False: By default, prunes clusters from smallest to largest. Set to True to prune by largest to smallest.
-            reversePruneByIntensity=True: Whether clusters should be pruned based on color intensity in order from darkest to lightest by default.
-            showPlots=False: Whether to show intermediate pruning plots for each iteration.
+            scale: The working scale relative to the full resolution image
         """
 
-        for i in range(iterations):
-            self.generatePrunableClusters(showPlots=False)
+        self.blurImage_(
+            blurType=self.blurType,
+            ksize=max(int(21 * scale) | 1, 3),
+            sigmaColor=21,
+            sigmaSpace=14 * scale,
+        )
 
-            image = self.image.copy().astype(np.int32)
-            prunableClusters = self.prunableClusters
+    def smoothAndPrune_(self):
+        """
+        The optional mode filter and the pruning set_final_pbn() runs on the quantized image
+        """
 
-            mergedColors = -np.ones_like(image, dtype=np.int32)
+        if self.modeFilterSize:
+            self.modeFilter_(self.modeFilterSize, self.modeFilterPasses)
+        if self.pruner == "graph":
+            self.pruneClustersGraph()
+        elif self.pruner == "fill":
+            self.pruneClustersFill()
+        elif self.pruner == "simple":
+            self.pruneClustersSimple()
 
-            if showPlots:
-                plt.figure(figsize=(20, 20)), plt.imshow(self.image), plt.title(
-                    "Before pruning"
-                ), plt.show()
+    def getTiles(self, tileSize: int, margin: int = 0):
+        """
+        Yields the tiles covering the image in raster order
 
-            colorsOrdered = sorted(
-                prunableClusters.items(),
-                key=lambda x: np.sum(np.array(x[0])) ** 2,
-                reverse=reversePruneByIntensity,
-            )
+        Arguments:
+            tileSize: The side length of the tiles, tiles on the right and bottom edges can be smaller
+            margin=0: How far each tile's crop reaches past the tile on every side, clipped to the image
 
-            for color, labelMask in colorsOrdered:
-                color = np.array(color, dtype=np.uint8)
+        Yields:
+            (tile, crop)
 
-                uniqueLabels = np.unique(labelMask)[1:]
+            tile: The (top, bottom, left, right) of the tile in the image
+            crop: The (top, bottom, left, right) of the tile plus its margin in the image
+        """
 
-                # Get the labels in an order sorted by their patch size in the labelMask excluding the last element which is the background
-                if pruneBySize:
-                    uniqueLabels = np.array(
-                        sorted(
-                            uniqueLabels, key=lambda x: Counter(labelMask.flatten())[x]
-                        )[:-1]
-                    )
-                    if reversePruneBySize:
-                        uniqueLabels[::-1]
+        H, W = self.getImageSize()
+        for top in range(0, H, tileSize):
+            for left in range(0, W, tileSize):
+                bottom, right = min(top + tileSize, H), min(left + tileSize, W)
+                yield (top, bottom, left, right), (
+                    max(top - margin, 0),
+                    min(bottom + margin, H),
+                    max(left - margin, 0),
+                    min(right + margin, W),
+                )
 
-                # plt.figure(figsize=(20, 20)), plt.imshow(labelMask), plt.title('labelMask'), plt.show()
+    def processTiles(self, scale: float = 1):
+        """
+        The blur, clustering and pruning stages of set_final_pbn() for images too large to process at once. One palette is fit on a
+        copy of the image downscaled to the size of a tile, and every tile is blurred, mapped onto the palette through its lookup
+        table, smoothed and pruned on its own with tileOverlap pixels of margin on every side so it sees the regions crossing its
+        edges. Only the tile is kept from each result, written into a uint8 index image of the whole image, which is the only
+        full size array besides the input. Neighbouring tiles can still prune a region on their seam differently, so small regions
+        along the seams are pruned again afterwards with reconcileSeams(). With tileWorkers > 1 the tiles are processed in that
+        many processes, with at most two tiles per process queued at a time.
 
-                # If no unique labels are detected, continue to the next color
-                if uniqueLabels.shape[0] == 0:
-                    continue
+        Arguments:
+            scale: The working scale relative to the full resolution image, for the blur
+        """
+
+        image = self.image
+        H, W = self.getImageSize()
+        tileSize, margin = self.tileSize, self.tileOverlap
+
+        # The quantizers fit the palette to self.image, which is the downscaled copy while fitting
+        self.setImage(
+            self.resizeImage(image=image, scale=min((tileSize**2 / (H * W)) ** 0.5, 1))
+        )
+        palette, _ = getattr(self, self.QUANTIZERS[self.quantizer])()
+        self.getPaletteLookup()
+        self.setImage(image)
 
-                surroundingColors = self.getMainSurroundingColorVectorized(
-                    image, labelMask, uniqueLabels
+        # Tiles are labeled with the sorted colors setIndexImage() uses, so every tile shares the same indices
+        colors, paletteIndex = np.unique(
+            self.toUint8(palette * 255), axis=0, return_inverse=True
+        )
+        dtype = np.uint8 if colors.shape[0] <= 256 else np.uint16
+        minArea = H * W * self.pruningThreshold
+
+        # The template carries the settings and the palette to the tiles, but none of the images
+        template = copy.copy(self)
+        template.originalImage = template.originalImg1d = None
+        template.setIndexImage(np.zeros((1, 1), dtype=dtype), colors)
+        template.tileColors = colors
+        template.tilePaletteIndex = paletteIndex.reshape(-1).astype(dtype)
+        template.tileMinArea = minArea
+        template.tileScale = scale
+        template.trackMemory = False
+        template.verbose = False
+
+        indexImage = np.empty((H, W), dtype=dtype)
+        tiles = list(self.getTiles(tileSize, margin))
+
+        def storeTile(tile, tileIndexImage):
+            top, bottom, left, right = tile
+            indexImage[top:bottom, left:right] = tileIndexImage
+
+        if self.tileWorkers > 1:
+            with ProcessPoolExecutor(
+                self.tileWorkers,
+                initializer=_init_tile_worker,
+                initargs=(template,),
+            ) as executor:
+                pending = {}
+                for tile, crop in tiles:
+                    top, bottom, left, right = crop
+                    future = executor.submit(
+                        _process_tile, image[top:bottom, left:right], tile, crop
+                    )
+                    pending[future] = tile
+                    if len(pending) >= 2 * self.tileWorkers:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            storeTile(pending.pop(future), future.result())
+                for future in wait(pending).done:
+                    storeTile(pending[future], future.result())
+        else:
+            for tile, crop in tiles:
+                top, bottom, left, right = crop
+                storeTile(
+                    tile,
+                    template.processTile(image[top:bottom, left:right], tile, crop),
                 )
 
-                # Create an index mapping for each unique label
-                consistentIndexingMap = {
-                    label: index for index, label in enumerate(uniqueLabels)
-                }
+        print(f"Processed {len(tiles)} tiles")
 
-                # Create an indexed version of labelMask for non-zero labels
-                consistentLabelMask = np.zeros_like(labelMask)
+        if self.pruner is not None:
+            self.reconcileSeams(indexImage, minArea)
 
-                # Edit the current label mask so it has consistent integer values to quickly map them to colors
-                for label, index in consistentIndexingMap.items():
-                    consistentLabelMask[labelMask == label] = index
+        self.setIndexImage(indexImage, colors)
 
-                # Apply the mapping only to non-zero labels
-                image[labelMask != 0] = surroundingColors[
-                    consistentLabelMask[labelMask != 0]
-                ]
+    def processTile(self, image: np.ndarray, tile: tuple, crop: tuple) -> np.ndarray:
+        """
+        Blurs, quantizes, smooths and prunes one tile for processTiles(). Called on the template processTiles() makes, which holds
+        the palette lookup table and the shared colors
 
-            if showPlots:
-                plt.figure(figsize=(20, 20)), plt.imshow(mergedColors), plt.title(
-                    "mergedColors"
-                ), plt.show()
+        Arguments:
+            image: The (H, W, 3) uint8 RGB crop of the tile plus its margin
+            tile: The (top, bottom, left, right) of the tile in the image
+            crop: The (top, bottom, left, right) of image in the image
 
-                mergedColorsMask = (mergedColors == -1).astype(np.uint8)
-                plt.figure(figsize=(20, 20)), plt.imshow(
-                    mergedColorsMask * 255
-                ), plt.title("mergedColorsMask"), plt.show()
+        Returns:
+            indexImage: The index image of the tile without its margin
+        """
 
-                plt.figure(figsize=(20, 20)), plt.imshow(self.image), plt.title(
-                    "Before pruning"
-                ), plt.show()
-                # plt.figure(figsize=(20, 20)), plt.imshow(prunedImage), plt.title('After pruning'), plt.show()
-                plt.figure(figsize=(20, 20)), plt.imshow(image), plt.title(
-                    "After pruning"
-                ), plt.show()
+        pbn = copy.copy(self)
+        pbn.setImage(image)
+        pbn.pruningThreshold = self.tileMinArea / pbn.getImageArea()
 
-                plt.figure(figsize=(20, 20)), plt.imshow(
-                    np.abs(self.image - image)
-                ), plt.title("Diff"), plt.show()
+        pbn.blurForScale_(self.tileScale)
+        labels = pbn.lookupLabels(pbn.image, self.getPaletteLookup())
+        pbn.setIndexImage(self.tilePaletteIndex[labels], self.tileColors)
+        pbn.smoothAndPrune_()
 
-            self.setImage(image.copy())
+        top, bottom, left, right = tile
+        cropTop, _, cropLeft, _ = crop
+        return pbn.indexImage[
+            top - cropTop : bottom - cropTop, left - cropLeft : right - cropLeft
+        ]
 
-    def pruneClustersSimple(self, iterations: int = 3, showPlots=False, trySlow=False):
+    def reconcileSeams(self, indexImage: np.ndarray, minArea: float):
         """
-        A simple cluster pruning method which iteratively prunes the smallest clusters below the self.pruningThreshold class variable.
-        In most cases, this simple method produces similar results to pruneClustersSmart(), but is faster.
+        Fills the regions smaller than minArea along the seams between tiles, where neighbouring tiles made their pruning decisions
+        separately, from the nearest larger regions like pruneClustersFill(). Each seam is handled in windows reaching tileOverlap
+        pixels to either side of it. Regions touching the edge of a window that isn't an image edge may continue outside of it, so
+        the small ones are looked at again in a window grown around them until they are whole or reach minArea.
 
         Arguments:
-            iterations: How many times clusters are pruned by repeating this same function. A single iteration probably isn't
-                guaranteed to remove all small clusters, so this function can be run any number of times to ensure all clusters are pruned
+            indexImage: The (H, W) index image of the whole image, modified in place
+            minArea: The smallest area in pixels a region can have
         """
 
-        print(f"Starting pruning... \nIteration (of {iterations}): ", end="")
-
-        if trySlow:
-            print(
-                "WARNING: USING ITERATIVE self.getMainSurroundingColor()! EXPECT POOR PERFORMANCE"
-            )
-
-        for i in range(iterations):
-            print(f"{i+1} ", end="")
+        H, W = indexImage.shape
+        tileSize, margin = self.tileSize, self.tileOverlap
+
+        windows = []
+        for seam in range(tileSize, W, tileSize):
+            for top in range(0, H, tileSize):
+                windows.append(
+                    (
+                        max(top - margin, 0),
+                        min(top + tileSize + margin, H),
+                        max(seam - margin, 0),
+                        min(seam + margin, W),
+                    )
+                )
+        for seam in range(tileSize, H, tileSize):
+            for left in range(0, W, tileSize):
+                windows.append(
+                    (
+                        max(seam - margin, 0),
+                        min(seam + margin, H),
+                        max(left - margin, 0),
+                        min(left + tileSize + margin, W),
+                    )
+                )
 
-            image = self.image.copy().astype(np.int32)
-            # print('Starting generatePrunableClusters()')
-            self.generatePrunableClusters(showPlots=False)
-            # print('Done!')
+        numFilled = 0
+        while windows:
+            cutBoxes = []
+            for top, bottom, left, right in windows:
+                window = indexImage[top:bottom, left:right]
+                regionMap, _, areas, bboxes, _ = self.labelRegions(window)
+
+                x, y, w, h = bboxes.T
+                cut = (
+                    ((x == 0) & (left > 0))
+                    | ((y == 0) & (top > 0))
+                    | ((x + w == right - left) & (right < W))
+                    | ((y + h == bottom - top) & (bottom < H))
+                )
+                tooSmall = (areas < minArea) & ~cut
+                unknown = tooSmall[regionMap]
+                if unknown.any() and not unknown.all():
+                    self.fillUnknown(window, unknown)
+                    numFilled += np.count_nonzero(tooSmall)
+
+                # A small region cut by the window can still be small in the whole image, like a thin line reaching further
+                # than tileOverlap past the seam, so it's looked at again in a window around it
+                cutBoxes.extend(
+                    bboxes[(areas < minArea) & cut]
+                    + [left - margin, top - margin, 2 * margin, 2 * margin]
+                )
 
-            prunableClusters = self.prunableClusters
+            # A region cut by the new window has more pixels in it than before, so this ends once every region is whole or large
+            windows = []
+            if cutBoxes:
+                for x, y, w, h in self.mergeOverlappingBoxes(np.array(cutBoxes)):
+                    windows.append((max(y, 0), min(y + h, H), max(x, 0), min(x + w, W)))
 
-            if showPlots:
-                plt.figure(figsize=(20, 20)), plt.imshow(self.image), plt.title(
-                    "Before pruning"
-                ), plt.show()
+        print(f"Filled {numFilled} small clusters along tile seams")
 
-            # print('Starting pruning loop')
-            for color, labelMask in prunableClusters.items():
-                color = np.array(color, dtype=np.uint8)
+    @contextmanager
+    def trackStage(self, name: str):
+        """
+        Measures the memory a stage of set_final_pbn() allocates when self.trackMemory is set and tracemalloc is tracing, and adds
+        it to self.memoryReport. Does nothing otherwise. Only memory allocated while tracing is counted, so freeing an image from
+        before tracing started doesn't lower the net bytes.
 
-                uniqueLabels = np.unique(labelMask)[
-                    1:
-                ]  # Exclude the first label which refers to the background
+        Arguments:
+            name: The name of the stage in the report
+        """
 
-                # If no unique labels are detected, continue to the next color
-                if uniqueLabels.shape[0] == 0:
-                    continue
+        if not (self.trackMemory and tracemalloc.is_tracing()):
+            yield
+            return
 
-                if trySlow:
-                    # A much slower iterative version of cluster pruning
-                    surroundingColorsList = []
-                    for label in uniqueLabels:
-                        clusterMask = (labelMask != label).astype(np.uint8)
-                        surroundingColor = self.getMainSurroundingColor(
-                            image, clusterMask
-                        )
-                        surroundingColorsList.append(surroundingColor)
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        yield
+        after, peak = tracemalloc.get_traced_memory()
+        self.memoryReport.append(
+            {"stage": name, "peak": peak - before, "net": after - before}
+        )
 
-                    surroundingColors = np.array(surroundingColorsList, dtype=np.uint8)
+    def printMemoryReport(self):
+        """
+        Prints the memory report of set_final_pbn(). Peak is the most memory the stage had allocated on top of what was allocated
+        before it, and net is how much more is allocated after the stage than before it
+        """
 
-                    for idx in range(uniqueLabels.shape[0]):
-                        currentLabel = uniqueLabels[idx]
-                        currentColor = surroundingColors[idx, :]
-                        image[labelMask == currentLabel] = currentColor
+        print(f"{'stage':<12}{'peak (MB)':>12}{'net (MB)':>12}")
+        for entry in self.memoryReport:
+            print(
+                f"{entry['stage']:<12}{entry['peak'] / 2**20:>12.1f}{entry['net'] / 2**20:>12.1f}"
+            )
 
-                else:
-                    # The fast vectorized version
-                    surroundingColors = self.getMainSurroundingColorVectorized(
-                        image, labelMask, uniqueLabels
-                    )
+    def set_final_pbn(self):
+        """
+        Runs all necessary functions to get the final paint by number image
+        and set the internal image representation to it.
+        """
+        startedTracing = self.trackMemory and not tracemalloc.is_tracing()
+        if startedTracing:
+            tracemalloc.start()
+        self.memoryReport = []
+
+        with self.trackStage("plan"):
+            scale = self.planResolution(
+                self.maxPixels, self.outputSize, self.workingScale
+            )
 
-                    # Create an index mapping for each unique label
-                    consistentIndexingMap = {
-                        label: index for index, label in enumerate(uniqueLabels)
-                    }
+        if self.tileSize:
+            with self.trackStage("tiles"):
+                self.processTiles(scale)
+        else:
+            with self.trackStage("blur"):
+                self.blurForScale_(scale)
+            with self.trackStage("cluster"):
+                self.cluster_colors_()
+            with self.trackStage("prune"):
+                self.smoothAndPrune_()
+        # draw rectangle around image so border is recognized, in the index image with black added to the colors. The
+        # image stays at the working resolution, so the border is thinned to keep its width in the SVG
+        with self.trackStage("border"):
+            colors = np.vstack([self.indexColors, np.zeros((1, 3), dtype=np.uint8)])
+            img = self.indexImage.astype(
+                np.uint8 if colors.shape[0] <= 256 else np.uint16, copy=False
+            )
+            img = cv2.rectangle(
+                img,
+                (0, 0),
+                (img.shape[1], img.shape[0]),
+                colors.shape[0] - 1,
+                max(round(10 / self.outputScale), 1),
+            )
+            self.setIndexImage(img, colors)
 
-                    # Create an indexed version of labelMask for non-zero labels
-                    consistentLabelMask = np.zeros_like(labelMask)
+        if startedTracing:
+            tracemalloc.stop()
+        if self.trackMemory:
+            self.printMemoryReport()
 
-                    # Edit the current label mask so it has consistent integer values to quickly map them to colors
-                    for label, index in consistentIndexingMap.items():
-                        consistentLabelMask[labelMask == label] = index
+    def iterColorShapes(self):
+        """
+        Yields the contours of the shapes of each color for output_to_svg(). The contours are traced around the boundary pixels
+        of each color's mask, and only one cropped mask exists at a time
 
-                    # Apply the mapping only to non-zero labels
-                    image[labelMask != 0] = surroundingColors[
-                        consistentLabelMask[labelMask != 0]
-                    ]
+        Yields:
+            (color, contours)
 
-            if showPlots:
-                plt.figure(figsize=(20, 20)), plt.imshow(self.image), plt.title(
-                    "Before pruning"
-                ), plt.show()
-                plt.figure(figsize=(20, 20)), plt.imshow(image), plt.title(
-                    "After pruning"
-                ), plt.show()
+            color: An (R, G, B) tuple in the same order as getUniqueColors()
+            contours: The contours of the shapes of the color in image coordinates, as returned by cv2.findContours
+        """
 
-                plt.figure(figsize=(20, 20)), plt.imshow(
-                    np.abs(self.image - image)
-                ), plt.title("Diff"), plt.show()
+        # Contours are shifted back to image coordinates by the crop offset
+        for color, mask, offset in self.iterColorMasks(crop=True):
+            boundary_img = self.getBoundaryImage(mask.astype(np.uint8))
 
-            self.setImage(image)
+            # plt.imshow(boundary_img, cmap="gray")
+            # plt.show()
 
-        print("\nDone!")
+            contours, hierarchy = cv2.findContours(
+                boundary_img.astype(np.uint8),
+                cv2.RETR_EXTERNAL,
+                cv2.CHAIN_APPROX_TC89_L1,
+                offset=offset,
+            )
+            yield color, contours
 
-    def getBoundaryImage(
-        self, image: np.ndarray = None, scale: float = 1
-    ) -> np.ndarray:
+    def mergeOverlappingBoxes(self, boxes: np.ndarray, gap: int = 1) -> np.ndarray:
         """
-        Gets a boundary image between colors in a PBN template by running an edge filter on the provided image or self.image.
-        Upscaling the image before passing it to this function gives better resolution.
+        Merges boxes that overlap or come within gap pixels of each other until no two boxes do
 
         Arguments:
-            image: An input image to get the edges of. Uses self.image if image is None
-            scale: A value to scale the image by before applying the edge filter. Useful if you want higher resolution
-                in the resulting boundary image for labeling regions.
+            boxes: An (N, 4) numpy array of (x, y, width, height) boxes like cv2.boundingRect
+            gap=1: How far apart two boxes can be and still be merged
 
         Returns:
-            boundaryImage: A binary image that represents the boundaries found when applying the edge filter.
+            merged: An (M, 4) int numpy array of the merged (x, y, width, height) boxes
         """
 
-        img = None
-        if image is None:
-            img = self.getImage().astype(np.uint8)
-        else:
-            img = image.copy().astype(np.uint8)
-
-        edgeFilter = np.array(([0, 1, 0], [1, -4, 1], [0, 1, 0]))
+        x0, y0 = boxes[:, 0], boxes[:, 1]
+        x1, y1 = x0 + boxes[:, 2], y0 + boxes[:, 3]
 
-        if scale != 1:
-            img = self.resizeImage(image=img, scale=scale)
+        # Every merge can make the merged box reach new boxes, so the groups are linked again until their number settles
+        while True:
+            touching = (
+                (x0[:, None] < x1[None] + gap)
+                & (x0[None] < x1[:, None] + gap)
+                & (y0[:, None] < y1[None] + gap)
+                & (y0[None] < y1[:, None] + gap)
+            )
+            numGroups, groups = connected_components(
+                coo_matrix(touching), directed=False
+            )
+            if numGroups == x0.shape[0]:
+                break
 
-        boundaryImage = cv2.filter2D(img, ddepth=-1, kernel=edgeFilter)
-        boundaryImage = np.sum(boundaryImage, axis=2)
-        boundaryImage[boundaryImage > 0] = 1
+            left, top = np.full(numGroups, np.iinfo(np.int64).max), np.full(
+                numGroups, np.iinfo(np.int64).max
+            )
+            right, bottom = np.zeros(numGroups, dtype=np.int64), np.zeros(
+                numGroups, dtype=np.int64
+            )
+            np.minimum.at(left, groups, x0)
+            np.minimum.at(top, groups, y0)
+            np.maximum.at(right, groups, x1)
+            np.maximum.at(bottom, groups, y1)
+            x0, y0, x1, y1 = left, top, right, bottom
 
-        return boundaryImage
+        return np.stack([x0, y0, x1 - x0, y1 - y0], axis=1).astype(int)
 
-    def set_final_pbn(self):
+    def iterTileShapes(self):
         """
-        Runs all necessary functions to get the final paint by number image
-        and set the internal image representation to it.
+        Yields the same shapes as iterColorShapes() while tracing the image a tile at a time. Each tile is traced with 2 pixels of
+        its neighbours, and the boundary is closed along the cut edges so shapes crossing them are still filled. Shapes within 2
+        pixels of a seam may continue in the next tile, so only their bounding boxes are kept. Once all tiles are traced, the boxes
+        of each color that touch are merged and every merged box is traced again on the index image, which gives each shape
+        crossing a seam as a single contour. Shapes nested inside a shape crossing a seam are dropped like cv2.RETR_EXTERNAL does.
+        Memory use is bounded by the tile size and the largest shape crossing a seam.
+
+        Yields:
+            (color, contours)
+
+            color: An (R, G, B) tuple in the same order as getUniqueColors()
+            contours: The contours of the shapes of the color in image coordinates, as returned by cv2.findContours
         """
-        originalDims = self.getImage().shape[:-1]
-        self.blurImage_(blurType="bilateral", ksize=21, sigmaColor=21, sigmaSpace=14)
-        self.resizeImage_(0.5)
-        self.cluster_colors_()
-        self.pruneClustersSimple(iterations=6)
-        self.resizeImage_(dimension=originalDims)
-        # draw rectangle around image so border is recognized
-        img = self.getImage()
-        img = cv2.rectangle(img, (0, 0), (img.shape[1], img.shape[0]), (0, 0, 0), 10)
-        self.setImage(img)
+
+        indexImage, colors = self.getIndexImage()
+        H, W = indexImage.shape
+        tileSize = self.tileSize
+        shapes = [[] for _ in colors]
+        seamBoxes = [[] for _ in colors]
+
+        def nearSeam(x, y, w, h):
+            left, top = x // tileSize * tileSize, y // tileSize * tileSize
+            right, bottom = min(left + tileSize, W), min(top + tileSize, H)
+            return (
+                (x < left + 2 and left > 0)
+                or (y < top + 2 and top > 0)
+                or (x + w > right - 2 and right < W)
+                or (y + h > bottom - 2 and bottom < H)
+            )
+
+        for tile, crop in self.getTiles(tileSize, 2):
+            cropTop, cropBottom, cropLeft, cropRight = crop
+            indexCrop = indexImage[cropTop:cropBottom, cropLeft:cropRight]
+
+            for idx in np.unique(indexCrop):
+                mask = (indexCrop == idx).astype(np.uint8)
+                boundary = self.getBoundaryImage(mask)
+                if cropTop > 0:
+                    boundary[0] |= mask[0]
+                if cropBottom < H:
+                    boundary[-1] |= mask[-1]
+                if cropLeft > 0:
+                    boundary[:, 0] |= mask[:, 0]
+                if cropRight < W:
+                    boundary[:, -1] |= mask[:, -1]
+
+                contours, hierarchy = cv2.findContours(
+                    boundary.astype(np.uint8),
+                    cv2.RETR_TREE,
+                    cv2.CHAIN_APPROX_TC89_L1,
+                    offset=(cropLeft, cropTop),
+                )
+                parents = hierarchy[0, :, 3]
+                seam = [nearSeam(*cv2.boundingRect(c)) for c in contours]
+
+                # Every boundary line has an outer border whose parent is the hole border of the line around it, if any. Closing
+                # the cut edges can wrap a shape around others that aren't nested in the whole image, so only shapes inside a
+                # shape away from the seams are surely nested
+                for i, c in enumerate(contours):
+                    depth, parent = 0, parents[i]
+                    while parent >= 0:
+                        depth, parent = depth + 1, parents[parent]
+                    if depth % 2 == 1:
+                        continue
+                    # The parent of an outer border below the top level is always a hole border
+                    outer = parents[parents[i]] if depth else -1
+                    while outer >= 0 and seam[outer]:
+                        outer = parents[parents[outer]] if parents[outer] >= 0 else -1
+                    if outer >= 0:
+                        continue
+                    if seam[i]:
+                        seamBoxes[idx].append(cv2.boundingRect(c))
+                    else:
+                        shapes[idx].append(c)
+
+        for idx, color in enumerate(colors):
+            if not seamBoxes[idx]:
+                yield tuple(color), shapes[idx]
+                continue
+
+            seamShapes = []
+            # The approximated contours can cut a pixel off the corners of the pieces, so their boxes are padded
+            boxes = np.array(seamBoxes[idx]) + [-2, -2, 4, 4]
+            for x, y, w, h in self.mergeOverlappingBoxes(boxes):
+                top, bottom = max(y - 2, 0), min(y + h + 2, H)
+                left, right = max(x - 2, 0), min(x + w + 2, W)
+                mask = (indexImage[top:bottom, left:right] == idx).astype(np.uint8)
+                contours, hierarchy = cv2.findContours(
+                    self.getBoundaryImage(mask).astype(np.uint8),
+                    cv2.RETR_EXTERNAL,
+                    cv2.CHAIN_APPROX_TC89_L1,
+                    offset=(left, top),
+                )
+
+                # Shapes reaching out of the box belong to another box, and shapes away from the seams were traced with their tile
+                for c in contours:
+                    cx, cy, cw, ch = rect = cv2.boundingRect(c)
+                    if (
+                        cx >= x
+                        and cy >= y
+                        and cx + cw <= x + w
+                        and cy + ch <= y + h
+                        and nearSeam(*rect)
+                    ):
+                        seamShapes.append((rect, c))
+
+            interior = []
+            for c in shapes[idx]:
+                px, py = c[0, 0]
+                nested = any(
+                    sx < px < sx + sw
+                    and sy < py < sy + sh
+                    and cv2.pointPolygonTest(s, (int(px), int(py)), False) > 0
+                    for (sx, sy, sw, sh), s in seamShapes
+                )
+                if not nested:
+                    interior.append(c)
+
+            yield tuple(color), interior + [c for _, c in seamShapes]
 
     def output_to_svg(self, svg_path: str, output_palette_path: str = None):
         """
@@ -822,38 +3224,27 @@ class PbnGen:
         Arguments:
             svg_path: File path to output the svg to.
         Returns:
-            palette: A dictionary of all colors in the image each with an array
-            of unique html ids representing each shape. This will allow for javascript
-            manipulation of the color of each shape.
+            palette: A dictionary of all colors in the image each with the number
+            it is labeled with in the SVG and an array of unique html ids representing
+            each shape. This will allow for javascript manipulation of the color of each shape.
         """
-        h, w = self.getImage().shape[:2]
+        h, w = self.getOutputSize()
         dwg = svgwrite.Drawing(svg_path, profile="tiny", viewBox=(f"0 0 {w} {h}"))
         i = 0
         palette = []
-        color_masks = self.getUniqueColorsMasks()
-
-        for idx, (color, mask) in enumerate(color_masks.items()):
-            mask[mask == False] = 0
-            mask[mask == True] = 1
-            boundary_img = self.getBoundaryImage(mask)
-
-            # plt.imshow(boundary_img, cmap="gray")
-            # plt.show()
-
-            contours, hierarchy = cv2.findContours(
-                boundary_img.astype(np.uint8),
-                cv2.RETR_EXTERNAL,
-                cv2.CHAIN_APPROX_TC89_L1,
-            )
+        numbers = self.getColorNumbers(
+            [tuple(color) for color in self.getUniqueColors()]
+        )
 
+        shapes = self.iterTileShapes() if self.tileSize else self.iterColorShapes()
+        for color, contours in shapes:
             data = {}
             color_str = str(color)
             data["color"] = color_str
+            data["number"] = numbers[color]
             data["shapes"] = []
             for c in contours:
-                points = c.squeeze().tolist()
-                if len(c.squeeze().shape) == 1:
-                    points = [points]
+                points = self.scaleContour(c)
 
                 fill = "white"
                 # fill = "rgb" + str(color)
@@ -861,7 +3252,7 @@ class PbnGen:
                 shape = dwg.polygon(points)
 
                 # add text label
-                text = self.add_text_label(dwg, c, str(idx))
+                text = self.add_text_label(dwg, c, str(numbers[color]))
 
                 group.add(shape)
                 group.add(text)
@@ -881,6 +3272,38 @@ class PbnGen:
 
         return palette
 
+    def getColorNumbers(self, colors) -> dict:
+        """
+        Gets the number each color is labeled with in the SVG. Colors are numbered in order, except with a fixed palette where each
+        color gets its index in the palette so every image made with the same palette is numbered the same way. Colors that
+        aren't in the fixed palette, like the black border, are numbered after it.
+
+        Arguments:
+            colors: An iterable of (R, G, B) tuples in the order they are drawn
+
+        Returns:
+            numbers: A dictionary mapping each color tuple to its number
+        """
+
+        paletteNumbers = {}
+        if self.fixedPalette is not None:
+            paletteNumbers = {
+                tuple(color): idx
+                for idx, color in enumerate(self.fixedPalette.tolist())
+            }
+
+        numbers = {}
+        nextNumber = len(paletteNumbers)
+        for color in colors:
+            key = tuple(int(c) for c in color)
+            if key in paletteNumbers:
+                numbers[color] = paletteNumbers[key]
+            else:
+                numbers[color] = nextNumber
+                nextNumber += 1
+
+        return numbers
+
     def point_inside_contour(self, point, contour):
         """Check if a point is inside a contour."""
         return cv2.pointPolygonTest(contour, (point[0], point[1]), False) >= 0
@@ -917,10 +3340,14 @@ class PbnGen:
         return best_point
 
     def add_text_label(self, dwg, contour, label):
-        best_point = self.sample_text_position(contour)
+        x, y = self.sample_text_position(contour)
+        scaleX, scaleY = self.getOutputScales()
+        best_point = (x * scaleX, y * scaleY)
 
         # Estimate a suitable text size
-        text_size = np.clip(np.sqrt(cv2.contourArea(contour)) / 8, 4, 12)
+        text_size = np.clip(
+            np.sqrt(cv2.contourArea(contour)) * self.outputScale / 8, 4, 12
+        )
 
         text = dwg.text(
             label,
@@ -930,3 +3357,238 @@ class PbnGen:
         )
         return text
         # dwg.add(text)
+
+
+def fit_shared_palette(
+    f_names: list, num_colors: int = 15, histogramBits: int = 5
+) -> np.ndarray:
+    """
+    Fits one palette for a series of images with a single clustering pass. The color histograms of all images are combined
+    and weighted K means is run over the occupied bins, so the cost is one fit no matter how many images there are. The fit
+    is done in CIELAB since PbnGen maps images onto a fixed palette by CIELAB distance.
+
+    Arguments:
+        f_names: Paths to the images
+        num_colors: The number of colors in the shared palette
+        histogramBits: Bits per channel of the combined histogram
+
+    Returns:
+        palette: A (num_colors, 3) uint8 numpy array of RGB colors that can be passed as the palette argument of PbnGen
+    """
+
+    numBins = 1 << (3 * histogramBits)
+    counts = np.zeros(numBins)
+    colorSums = np.zeros((numBins, 3))
+
+    # Only one decoded image is held in memory at a time, the histogram is all that's needed from it
+    for f_name in f_names:
+        with open(f_name, "rb") as f:
+            bgr_image, _ = decode_image(f.read())
+        pixels = cv2.cvtColor(bgr_image, cv2.COLOR_BGR2RGB, dst=bgr_image).reshape(
+            (-1, 3)
+        )
+        _, bins, binCounts, binColors = PbnGen.getColorHistogram(pixels, histogramBits)
+        counts[bins] += binCounts
+        colorSums[bins] += binColors * binCounts[:, np.newaxis]
+
+    bins = np.flatnonzero(counts)
+    binColors = (colorSums[bins] / counts[bins, np.newaxis]).astype(np.float32)
+
+    model = KMeans(
+        n_clusters=min(num_colors, bins.shape[0]),
+        n_init="auto",
+        random_state=random_state,
+    )
+    model.fit(PbnGen.rgbToLab(binColors), sample_weight=counts[bins])
+
+    return np.rint(PbnGen.labToRgb(model.cluster_centers_)).astype(np.uint8)
+
+
+def batch_pbn(
+    f_names: list,
+    output_dir: str,
+    num_colors: int = 15,
+    output_palette_path: str = None,
+    **kwargs,
+) -> list:
+    """
+    Generates paint by numbers for a series of images that share one palette, so every image is numbered the same way.
+    The palette is fit once with fit_shared_palette(), each image is mapped onto it and saved as <image name>.svg in
+    output_dir, and a single palette JSON is written for the whole series instead of one per image.
+
+    Arguments:
+        f_names: Paths to the images
+        output_dir: The directory the SVGs are written to
+        num_colors: The number of colors in the shared palette
+        output_palette_path: Where to write the shared palette JSON. Defaults to palette.json in output_dir
+        kwargs: Any other PbnGen constructor arguments
+
+    Returns:
+        palette: A list with one entry per color, ordered by its number, holding the color and the shape ids
+            of that color in each SVG keyed by the SVG file name
+    """
+
+    sharedPalette = fit_shared_palette(f_names, num_colors)
+    print(f"Fit a shared palette of {sharedPalette.shape[0]} colors")
+
+    palette = {}
+    for f_name in f_names:
+        svg_name = os.path.splitext(os.path.basename(f_name))[0] + ".svg"
+
+        pbn = PbnGen(f_name, palette=sharedPalette, **kwargs)
+        pbn.set_final_pbn()
+        image_palette = pbn.output_to_svg(os.path.join(output_dir, svg_name))
+
+        colors = [tuple(color) for color in pbn.getUniqueColors()]
+        numbers = pbn.getColorNumbers(colors)
+        for color, data in zip(colors, image_palette):
+            entry = palette.setdefault(
+                numbers[color],
+                {"number": numbers[color], "color": data["color"], "shapes": {}},
+            )
+            entry["shapes"][svg_name] = data["shapes"]
+
+    palette = [palette[number] for number in sorted(palette)]
+
+    if output_palette_path is None:
+        output_palette_path = os.path.join(output_dir, "palette.json")
+    with open(output_palette_path, "w") as outfile:
+        json.dump(palette, outfile)
+
+    return palette
+
+
+def get_working_scale(
+    size: tuple, maxPixels: int = None, outputSize: tuple = None, maxScale: float = 1
+) -> "tuple[float, float]":
+    """
+    Gets the resolution PbnGen.planResolution() works at for an image of the given size. The working scale is the largest one
+    that is at most maxScale, fits in maxPixels and isn't larger than the output needs.
+
+    Arguments:
+        size: The (H, W) of the full resolution image
+        maxPixels=None: The pixel budget of the working image. No limit if None
+        outputSize=None: The (H, W) box the SVG should fit in. Defaults to the size of the image
+        maxScale: The largest working scale to use, even if the image fits the budget
+
+    Returns:
+        (scale, outputScale)
+
+        scale: The working scale relative to the full resolution image
+        outputScale: The scale from the full resolution image to the SVG
+    """
+
+    H, W = size
+    outputScale = 1 if outputSize is None else min(outputSize[0] / H, outputSize[1] / W)
+
+    scale = min(maxScale, outputScale, 1)
+    if maxPixels is not None:
+        scale = min(scale, (maxPixels / (H * W)) ** 0.5)
+
+    return scale, outputScale
+
+
+def get_jpeg_size(data: bytes) -> tuple:
+    """
+    Reads the size of a JPEG from its frame header without decoding it. This is the stored size, before any EXIF rotation.
+
+    Arguments:
+        data: The encoded image
+
+    Returns:
+        size: The (H, W) of the image, or None if data isn't a JPEG
+    """
+
+    if data[:2] != b"\xff\xd8":
+        return None
+
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Markers can be padded with any number of fill bytes
+            i += 1
+            continue
+
+        # The start of frame markers, except DHT, JPG and DAC which share the range
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return (
+                int.from_bytes(data[i + 5 : i + 7], "big"),
+                int.from_bytes(data[i + 7 : i + 9], "big"),
+            )
+
+        i += 2 + int.from_bytes(data[i + 2 : i + 4], "big")
+
+    return None
+
+
+def decode_image(
+    data: bytes, maxPixels: int = None, outputSize: tuple = None, maxScale: float = 1
+) -> "tuple[np.ndarray, tuple]":
+    """
+    Decodes an image to BGR like cv2.imdecode. JPEGs are decoded at 1/2, 1/4 or 1/8 size by DCT scaling when the working
+    resolution get_working_scale() plans with the same arguments is at most that size, which cuts the decode time and the
+    decoded image's memory by up to 64x. The decoder applies the EXIF orientation in the same step, at the reduced size.
+
+    Arguments:
+        data: The encoded image
+        maxPixels=None: The pixel budget of the working image. No limit if None
+        outputSize=None: The (H, W) box the SVG should fit in. Defaults to the size of the image
+        maxScale: The largest working scale to use, even if the image fits the budget
+
+    Returns:
+        (image, size)
+
+        image: The decoded (H, W, 3) uint8 BGR numpy array
+        size: The (H, W) of the full resolution image after the EXIF orientation is applied
+    """
+
+    jpegSize = get_jpeg_size(data)
+
+    factor = 1
+    if jpegSize is not None:
+        H, W = jpegSize
+        # The EXIF orientation isn't known yet, so the output size is fit with the image either way up
+        scale = max(
+            get_working_scale((H, W), maxPixels, outputSize, maxScale)[0],
+            get_working_scale((W, H), maxPixels, outputSize, maxScale)[0],
+        )
+        factor = next((f for f in (8, 4, 2) if scale * f <= 1), 1)
+
+    flags = {
+        1: cv2.IMREAD_COLOR,
+        2: cv2.IMREAD_REDUCED_COLOR_2,
+        4: cv2.IMREAD_REDUCED_COLOR_4,
+        8: cv2.IMREAD_REDUCED_COLOR_8,
+    }[factor]
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+    assert image is not None, "Could not decode the image"
+
+    h, w = image.shape[:2]
+    if jpegSize is None:
+        return image, (h, w)
+
+    if factor > 1:
+        print(f"Decoded at 1/{factor} size")
+
+    # The decoder rounds reduced sizes up, a swapped size means the EXIF orientation rotated the image
+    H, W = jpegSize
+    if (h, w) != (-(-H // factor), -(-W // factor)):
+        H, W = W, H
+
+    return image, (H, W)
+
+
+# The template PbnGen.processTiles() sends to each worker process once, instead of with every tile
+_tile_template = None
+
+
+def _init_tile_worker(template: PbnGen):
+    global _tile_template
+    _tile_template = template
+
+
+def _process_tile(image: np.ndarray, tile: tuple, crop: tuple) -> np.ndarray:
+    return _tile_template.processTile(image, tile, crop)
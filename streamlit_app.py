@@ -49,15 +49,16 @@ except ImportError as e:
 # Create a wrapper class that works with either version
 class PbnGenWrapper:
     def __init__(self, image_path, num_colors=None):
+        # When no number of colors is given, use the histogram based selection since the knee search is too slow for interactive use
         if PBN_MODULE == "src":
-            self.pbn = SrcPbnGen(image_path, num_colors=num_colors)
+            self.pbn = SrcPbnGen(image_path, num_colors=num_colors, autoColors="histogram", reducedDecode=True)
         elif PBN_MODULE == "functions":
             # For functions version, we need to load the image first
             bgr_image = cv2.imread(image_path)
-            self.pbn = FuncPbnGen(bgr_image, num_colors=num_colors)
+            self.pbn = FuncPbnGen(bgr_image, num_colors=num_colors, autoColors="histogram")
         elif PBN_MODULE == "simple":
-            # Use our simplified implementation
-            self.pbn = SimplePbnGen(image_path, num_colors=num_colors)
+            # Use our simplified implementation, which has no automatic color selection
+            self.pbn = SimplePbnGen(image_path, num_colors=num_colors or 15)
         else:
             raise ImportError("No PbnGen implementation available")
 
@@ -94,7 +95,8 @@ Upload an image to get started!
 
 # Sidebar with options
 st.sidebar.header("Options")
-num_colors = st.sidebar.slider("Number of Colors", min_value=5, max_value=30, value=15)
+auto_colors = st.sidebar.checkbox("Pick number of colors automatically", value=False)
+num_colors = None if auto_colors else st.sidebar.slider("Number of Colors", min_value=5, max_value=30, value=15)
 
 # File uploader
 uploaded_file = st.sidebar.file_uploader("Upload an image", type=["jpg", "jpeg", "png"])
@@ -170,7 +172,7 @@ def display_svg_with_coloring(svg_content, palette):
         col_idx = idx % 3
         with color_cols[col_idx]:
             if st.button(
-                f"Color {idx+1}",
+                f"Color {color_data.get('number', idx)}",
                 key=f"color_{idx}",
                 help=f"RGB: {color}",
                 use_container_width=True,
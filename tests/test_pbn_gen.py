@@ -0,0 +1,221 @@
+import os
+import sys
+import xml.etree.ElementTree as ET
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import src.pbn_gen as pbn_gen
+from src.pbn_gen import PbnGen
+
+
+@pytest.fixture
+def image_path(tmp_path):
+    # A smooth color gradient has enough distinct colors for any palette size
+    y, x = np.mgrid[0:64, 0:64]
+    image = np.stack([x * 4, y * 4, (x + y) * 2], axis=-1).astype(np.uint8)
+    path = str(tmp_path / "gradient.png")
+    cv2.imwrite(path, image)
+    return path
+
+
+@pytest.mark.parametrize("quantizer", [q for q in PbnGen.QUANTIZERS if q != "fixed"])
+def test_requantize_after_reclustering(image_path, monkeypatch, quantizer):
+    monkeypatch.setattr(pbn_gen, "random_state", 0)
+    pbn = PbnGen(image_path, num_colors=18, quantizer=quantizer)
+    pbn.cluster_colors()
+    pbn.requantize()
+
+    # Re-clustering to fewer colors must not reuse the lookup table of the previous palette
+    pbn.num_colors = 4
+    palette, _, _ = pbn.cluster_colors()
+    q_img = pbn.requantize()
+
+    colors = np.unique(q_img.reshape(-1, 3), axis=0)
+    expected = np.unique(pbn.toUint8(palette * 255), axis=0)
+    assert len(colors) <= 4
+    assert np.isin(colors.view("u1,u1,u1"), expected.view("u1,u1,u1")).all()
+
+
+def test_svg_labels_match_palette_numbers(tmp_path, monkeypatch):
+    monkeypatch.setattr(pbn_gen, "random_state", 0)
+    # Blocks of kit colors in a scrambled order, so the kit numbers differ from the sorted color order
+    kit = np.array(pbn_gen.paint_kits["basic12"], dtype=np.uint8)
+    blocks = kit[[9, 1, 5, 11, 0, 7, 3, 10, 2]].reshape(3, 3, 3)
+    image = np.repeat(np.repeat(blocks, 40, axis=0), 40, axis=1)
+    path = str(tmp_path / "blocks.png")
+    cv2.imwrite(path, image[..., ::-1])
+
+    pbn = PbnGen(path, palette="basic12")
+    pbn.set_final_pbn()
+    palette = pbn.output_to_svg(str(tmp_path / "pbn.svg"))
+
+    numbers = {shape: entry["number"] for entry in palette for shape in entry["shapes"]}
+    svg = "{http://www.w3.org/2000/svg}"
+    groups = ET.parse(tmp_path / "pbn.svg").getroot().iter(svg + "g")
+    labels = {group.get("id"): group.find(svg + "text").text for group in groups}
+    assert len(labels) > 9
+    assert labels == {shape: str(number) for shape, number in numbers.items()}
+    assert {entry["number"] for entry in palette} >= {9, 1, 5, 11, 0, 7, 3, 10, 2}
+
+
+def test_tiled_shapes_match_untiled(image_path):
+    # Blocks of a few colors with speckles give many shapes crossing the seams, and shapes nested inside others
+    rng = np.random.default_rng(0)
+    blocks = rng.integers(0, 4, (22, 27)).astype(np.uint8)
+    indexImage = cv2.resize(blocks, (80, 64), interpolation=cv2.INTER_NEAREST)
+    indexImage[rng.random(indexImage.shape) < 0.05] = 3
+    colors = np.array(
+        [[255, 0, 0], [0, 255, 0], [0, 0, 255], [255, 255, 255]], dtype=np.uint8
+    )
+
+    pbn = PbnGen(image_path)
+    pbn.setIndexImage(indexImage, colors)
+    untiled = [(color, len(contours)) for color, contours in pbn.iterColorShapes()]
+    pbn.tileSize = 16
+    tiled = [(color, len(contours)) for color, contours in pbn.iterTileShapes()]
+    assert tiled == untiled
+
+
+def test_reconcile_seams_prunes_regions_crossing_seams(image_path):
+    pbn = PbnGen(image_path)
+    pbn.tileSize, pbn.tileOverlap = 32, 2
+    indexImage = np.zeros((64, 64), dtype=np.uint8)
+    # A thin line crossing a seam reaches past the seam windows, and a large block crossing a seam must stay
+    indexImage[20:45, 30] = 1
+    indexImage[40:60, 10:40] = 2
+
+    pbn.reconcileSeams(indexImage, 50)
+    _, regionColors, areas, _, _ = pbn.labelRegions(indexImage)
+    assert areas.min() >= 50
+    assert sorted(regionColors.tolist()) == [0, 2]
+
+
+@pytest.mark.parametrize("quantizer", ["octree", "mediancut"])
+def test_quantizer_gives_exactly_num_colors(image_path, monkeypatch, quantizer):
+    monkeypatch.setattr(pbn_gen, "random_state", 0)
+    pbn = PbnGen(image_path, num_colors=12, quantizer=quantizer)
+    palette, labels, _ = pbn.cluster_colors()
+
+    assert palette.shape == (12, 3)
+    assert np.unique(labels).shape[0] == 12
+
+
+def speckled_index_image(seed=0, shape=(64, 80), numColors=4):
+    # Blocks of a few colors with single pixel speckles, so there are regions of every size
+    rng = np.random.default_rng(seed)
+    blocks = rng.integers(0, numColors, (shape[0] // 4, shape[1] // 4)).astype(np.uint8)
+    indexImage = cv2.resize(blocks, shape[::-1], interpolation=cv2.INTER_NEAREST)
+    speckles = rng.random(shape) < 0.05
+    indexImage[speckles] = rng.integers(0, numColors, np.count_nonzero(speckles))
+    colors = rng.integers(0, 256, (numColors, 3)).astype(np.uint8)
+    return indexImage, colors
+
+
+def add_exif_orientation(data, orientation):
+    # A big endian TIFF header with a single IFD entry for the orientation tag, in an APP1 segment right after the SOI marker
+    tiff = b"MM\x00\x2a\x00\x00\x00\x08\x00\x01"
+    tiff += b"\x01\x12\x00\x03\x00\x00\x00\x01" + orientation.to_bytes(2, "big")
+    tiff += b"\x00\x00\x00\x00\x00\x00"
+    segment = b"Exif\x00\x00" + tiff
+    return (
+        data[:2]
+        + b"\xff\xe1"
+        + (len(segment) + 2).to_bytes(2, "big")
+        + segment
+        + data[2:]
+    )
+
+
+def test_label_regions_matches_connected_components(image_path):
+    indexImage, colors = speckled_index_image()
+    pbn = PbnGen(image_path)
+    regionMap, regionColors, areas, bboxes, _ = pbn.labelRegions(indexImage)
+    assert (regionColors[regionMap] == indexImage).all()
+
+    for idx in range(colors.shape[0]):
+        mask = (indexImage == idx).astype(np.uint8)
+        _, _, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        regions = np.flatnonzero(regionColors == idx)
+        assert sorted(areas[regions].tolist()) == sorted(
+            stats[1:, cv2.CC_STAT_AREA].tolist()
+        )
+        assert sorted(map(tuple, bboxes[regions].tolist())) == sorted(
+            map(tuple, stats[1:, :4].tolist())
+        )
+
+
+@pytest.mark.parametrize(
+    "prune", ["pruneClustersGraph", "pruneClustersSimple", "pruneClustersFill"]
+)
+def test_no_region_below_threshold_after_pruning(image_path, prune):
+    indexImage, colors = speckled_index_image()
+    pbn = PbnGen(image_path)
+    pbn.setIndexImage(indexImage, colors)
+    pbn.pruningThreshold = 0.005
+    getattr(pbn, prune)()
+
+    prunedImage, prunedColors = pbn.getIndexImage()
+    _, _, areas, _, _ = pbn.labelRegions(prunedImage)
+    assert areas.min() >= pbn.getImageArea() * pbn.pruningThreshold
+    assert np.isin(prunedColors.view("u1,u1,u1"), colors.view("u1,u1,u1")).all()
+
+
+def test_mode_filter_keeps_color_set(image_path):
+    indexImage, _ = speckled_index_image()
+    pbn = PbnGen(image_path)
+    filtered = pbn.modeFilter(indexImage, ksize=3, passes=2)
+
+    assert filtered.shape == indexImage.shape
+    assert filtered.dtype == indexImage.dtype
+    assert set(np.unique(filtered)) == set(np.unique(indexImage))
+    # Speckles are replaced by the color around them
+    _, _, areas, _, _ = pbn.labelRegions(indexImage)
+    _, _, filteredAreas, _, _ = pbn.labelRegions(filtered)
+    assert np.count_nonzero(filteredAreas == 1) < np.count_nonzero(areas == 1)
+
+
+def test_decode_image_reduced_size_and_exif_orientation():
+    # A red block in the top left corner of a 240x320 image, which orientation 6 turns to the top right of a 320x240 image
+    image = np.full((240, 320, 3), 255, dtype=np.uint8)
+    image[:80, :80] = (0, 0, 255)
+    _, encoded = cv2.imencode(".jpg", image)
+    data = add_exif_orientation(encoded.tobytes(), 6)
+
+    assert pbn_gen.get_jpeg_size(data) == (240, 320)
+    _, png = cv2.imencode(".png", image)
+    assert pbn_gen.get_jpeg_size(png.tobytes()) is None
+
+    decoded, size = pbn_gen.decode_image(data)
+    assert decoded.shape == (320, 240, 3)
+    assert size == (320, 240)
+    assert decoded[10, -10, 2] > 200 > decoded[10, -10, 0]
+
+    reduced, size = pbn_gen.decode_image(data, maxPixels=320 * 240 // 16)
+    assert reduced.shape == (80, 60, 3)
+    assert size == (320, 240)
+    assert reduced[2, -2, 2] > 200 > reduced[2, -2, 0]
+
+
+def test_batch_pbn_shares_one_palette(image_path, tmp_path, monkeypatch):
+    monkeypatch.setattr(pbn_gen, "random_state", 0)
+    flipped_path = str(tmp_path / "flipped.png")
+    cv2.imwrite(flipped_path, cv2.imread(image_path)[::-1, ::-1])
+    sharedPalette = pbn_gen.fit_shared_palette([image_path, flipped_path], 6)
+
+    palette = pbn_gen.batch_pbn([image_path, flipped_path], str(tmp_path), num_colors=6)
+
+    assert (tmp_path / "gradient.svg").exists() and (tmp_path / "flipped.svg").exists()
+    numbers = [entry["number"] for entry in palette]
+    assert numbers == sorted(set(numbers))
+    assert len({entry["color"] for entry in palette}) == len(palette)
+    # Black is added for the border around every image
+    colors = np.vstack([sharedPalette, np.zeros((1, 3), dtype=np.uint8)])
+    assert {entry["color"] for entry in palette} <= {
+        str(tuple(color)) for color in colors
+    }
+    # The same color has the same number in both images
+    assert any(len(entry["shapes"]) == 2 for entry in palette)